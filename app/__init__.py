@@ -1,15 +1,32 @@
 import os
 
+from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
+from werkzeug.utils import cached_property
 
 db = SQLAlchemy()
 
 
+class App(Flask):
+    @cached_property
+    def robinhood(self):
+        import requests
+        from requests.adapters import HTTPAdapter
+        session = requests.Session()
+        session.mount('https://', HTTPAdapter(pool_maxsize=16))  # the account sync reads endpoints concurrently
+        json = session.post('https://api.robinhood.com/oauth2/token/',
+                            json={'username': os.environ['RH_USERNAME'], 'password': os.environ['RH_PASSWORD'],
+                                  'client_id': os.environ['RH_CLIENT_ID'],
+                                  'device_token': os.environ['RH_DEVICE_TOKEN'],
+                                  'expires_in': 86400, 'scope': 'internal', 'grant_type': 'password'}).json()
+        session.headers['Authorization'] = f"{json['token_type']} {json['access_token']}"
+        return session
+
+
 def create_app():
     from os import path
-    from flask import Flask
     from flask_migrate import Migrate
-    app = Flask(__name__, root_path=path.abspath(path.dirname(__file__) + '/..'))
+    app = App(__name__, root_path=path.abspath(path.dirname(__file__) + '/..'))
     app.config.from_object(Config)
     db.init_app(app)
     Migrate(app, db)
@@ -18,40 +35,72 @@ def create_app():
 
 
 def init_components(app):
+    # Subsystems are imported when a command runs or the shell starts, never at app creation: the analysis
+    # module drags in the scientific stack, and each module reads its own environment variables on first use.
     import logging
-    # import click
-    # import requests
-    # from .instrument import Instrument, update_instruments
-    # from .account import Portfolio, Position, update_rh_account
-    # from .m1 import M1Portfolio, update_m1_account
-    # from .analysis import Quote
-
-    # app.robinhood = requests.Session()
-    # json = requests.post('https://api.robinhood.com/oauth2/token/',
-    #                      json={'username': os.environ['RH_USERNAME'], 'password': os.environ['RH_PASSWORD'],
-    #                            'client_id': os.environ['RH_CLIENT_ID'], 'device_token': os.environ['RH_DEVICE_TOKEN'],
-    #                            'expires_in': 86400, 'scope': 'internal', 'grant_type': 'password'}).json()
-    # app.robinhood.headers['Authorization'] = f"{json['token_type']} {json['access_token']}"
-    app.shell_context_processor(lambda: {
-        'db': db,
-        # 'rh': app.robinhood,
-        # 'Instrument': Instrument,
-        # 'Portfolio': Portfolio,
-        # 'Position': Position,
-        # 'Quote': Quote,
-        # 'M1Portfolio': M1Portfolio,
-    })
-
-    # app.cli.command()(
-    #     click.option('--popularity_cutoff', default=300)(
-    #         update_instruments))
-    # app.cli.command()(update_rh_account)
-    # app.cli.command()(update_m1_account)
-    # app.cli.command()(Quote.usd_cny)
+    import click
+
+    def shell_context():
+        from werkzeug.local import LocalProxy
+        from .instrument import Instrument
+        from .account import Portfolio, Position
+        from .m1 import M1Portfolio
+        from .snapshot import EquitySnapshot
+        from .analysis import Quote
+        return {'db': db, 'rh': LocalProxy(lambda: app.robinhood), 'Instrument': Instrument, 'Portfolio': Portfolio,
+                'Position': Position, 'Quote': Quote, 'M1Portfolio': M1Portfolio, 'EquitySnapshot': EquitySnapshot}
+
+    app.shell_context_processor(shell_context)
+
+    command(app, '.instrument', 'update_instruments',
+            click.option('--popularity_cutoff', default=300))
+    command(app, '.crawler', 'crawl_instruments',
+            click.option('--popularity_cutoff', default=300),
+            click.option('--restart', is_flag=True),
+            click.option('--sync', is_flag=True))
+    command(app, '.crawler', 'work_instruments',
+            click.option('--burst', is_flag=True))
+    command(app, '.instrument', 'refresh_instruments',
+            click.option('--budget', default=1000))
+    command(app, '.account', 'update_rh_account',
+            click.option('--full', is_flag=True))
+    command(app, '.account', 'recompute_returns',
+            click.option('--symbol', 'symbols', multiple=True))
+    command(app, '.m1', 'update_m1_account')
+    command(app, '.m1', 'backfill_m1_account',
+            click.option('--start', type=click.DateTime(['%Y-%m-%d']), callback=lambda ctx, param, v: v and v.date()),
+            click.option('--end', type=click.DateTime(['%Y-%m-%d']), callback=lambda ctx, param, v: v and v.date()),
+            click.option('--workers', default=8))
+    command(app, '.sync', 'sync_accounts',
+            click.option('--workers', type=int))
+    command(app, '.snapshot', 'poll_equity',
+            click.option('--interval', default=60),
+            click.option('--flush_interval', default=900),
+            click.option('--duration', type=int))
+    command(app, '.analysis', 'Quote.usd_cny')
+    command(app, '.benchmark', 'benchmark_sync',
+            click.option('--fixtures', default='fixtures'),
+            click.option('--record', is_flag=True),
+            click.option('--latency', default=.05))
+    command(app, '.benchmark', 'benchmark_import',
+            click.option('--limit', default=1.))
     app.logger.setLevel(logging.INFO)
 
 
+def command(app, module, name, *options):
+    def run(**kwargs):
+        from importlib import import_module
+        target = import_module(module, __name__)
+        for attr in name.split('.'):
+            target = getattr(target, attr)
+        return target(**kwargs)
+
+    for option in reversed(options):
+        run = option(run)
+    app.cli.command(name.split('.')[-1].replace('_', '-'))(run)
+
+
 class Config:
     SQLALCHEMY_DATABASE_URI = 'sqlite:///db/portfolio'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
-    SQLALCHEMY_ECHO = int(os.environ['SQLALCHEMY_ECHO'])
+    SQLALCHEMY_ECHO = bool(int(os.environ.get('SQLALCHEMY_ECHO', 0)))
@@ -1,13 +1,22 @@
+import collections
 import os
-from datetime import datetime, date
-from statistics import mean
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, date, timedelta, timezone
+from urllib.parse import urlencode
 
 from sqlalchemy import func
+from sqlalchemy.orm import selectinload
 
-from app.instrument import Instrument
+from app.instrument import Instrument, fetch_prices
 from . import db
+from .bulk import bulk_upsert
+from .rebalance import rebalance_portfolio
 
-MARGIN_LIMIT = int(os.environ['MARGIN_LIMIT'])
+SYNC_LOOKBACK = timedelta(days=7)
+
+
+def margin_limit():
+    return int(os.environ['MARGIN_LIMIT'])
 
 
 class Transfer(db.Model):
@@ -20,15 +29,21 @@ class Transfer(db.Model):
 
     @classmethod
     def create_or_update(cls, id, created_at, direction, amount):
+        values = cls.parse(id, created_at, direction, amount)
         inst = cls.query.get(id)
         if not inst:
             inst = cls(id=id)
             db.session.add(inst)
-        inst.created_at = datetime.fromisoformat(created_at.replace('Z', '+00:00'))
-        assert direction == 'deposit'
-        inst.amount = float(amount)
+        for k, v in values.items():
+            setattr(inst, k, v)
         return inst
 
+    @staticmethod
+    def parse(id, created_at, direction, amount):
+        assert direction == 'deposit'
+        return {'id': id, 'created_at': datetime.fromisoformat(created_at.replace('Z', '+00:00')),
+                'amount': float(amount)}
+
 
 class Portfolio(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -40,6 +55,9 @@ class Portfolio(db.Model):
     cash_value = db.Column(db.Float, nullable=False)
     today_return_pct = db.Column(db.Float)
     total_return_pct = db.Column(db.Float)
+    # running aggregates of cost over the days with positive equity, carried forward from previous
+    cost_sum = db.Column(db.Float)
+    cost_count = db.Column(db.Integer)
     last_update = db.Column(db.DateTime)
     # relationship
     previous_id = db.Column(db.Integer, db.ForeignKey('portfolio.id'))
@@ -51,7 +69,7 @@ class Portfolio(db.Model):
             f' | {self.today_return_pct}%/{self.total_return_pct}%'
 
     @classmethod
-    def create_or_update(cls, cost):
+    def create_or_update(cls, cost, stocks=None, coins=None):
         today, rh = date.today(), db.get_app().robinhood
         inst = cls.query.filter_by(date=today).first()
         if not inst:
@@ -59,19 +77,20 @@ class Portfolio(db.Model):
             inst = cls(date=today, previous=previous)
             db.session.add(inst)
         inst.cost = cost
-        json = rh.get('https://api.robinhood.com/portfolios/').json()
+        json = stocks or rh.get('https://api.robinhood.com/portfolios/').json()
         inst.stocks_value = float(json['results'][0]['market_value'])
         equity = float(json['results'][0]['extended_hours_equity'] or json['results'][0]['equity'])
         market_value = float(json['results'][0]['extended_hours_market_value'] or json['results'][0]['market_value'])
         inst.cash_value = round(equity - market_value, 2)
-        json = rh.get('https://nummus.robinhood.com/portfolios/').json()
+        json = coins or rh.get('https://nummus.robinhood.com/portfolios/').json()
         inst.coins_value = float(json['results'][0]['extended_hours_market_value']
                                  or json['results'][0]['market_value'])
         inst.equity = round(inst.stocks_value + inst.coins_value + inst.cash_value, 2)
         inst.today_return_pct = round((inst.equity - inst.cost_today) /
                                       (inst.cost_today if inst.equity > 0 else
                                        (inst.previous.equity if inst.previous else 0)) * 100, 2)
-        inst.total_return_pct = round((inst.equity - inst.cost) / mean(inst.cost_timeline()) * 100, 2)
+        inst.accumulate_cost()
+        inst.total_return_pct = round((inst.equity - inst.cost) / inst.average_cost * 100, 2)
         inst.last_update = datetime.utcnow()
         return inst
 
@@ -80,6 +99,15 @@ class Portfolio(db.Model):
         prev_equity, prev_cost = (self.previous.equity, self.previous.cost) if self.previous else (0, 0)
         return prev_equity + self.cost - prev_cost
 
+    def accumulate_cost(self):
+        prev_sum, prev_count = (self.previous.cost_sum, self.previous.cost_count) if self.previous else (0, 0)
+        self.cost_sum = round(prev_sum + (self.cost if self.equity > 0 else 0), 2)
+        self.cost_count = prev_count + (1 if self.equity > 0 else 0)
+
+    @property
+    def average_cost(self):
+        return self.cost_sum / self.cost_count
+
     def cost_timeline(self):
         cur = self
         while cur:
@@ -87,6 +115,15 @@ class Portfolio(db.Model):
                 yield cur.cost
             cur = cur.previous
 
+    @classmethod
+    def history(cls, start=None):
+        columns = ('equity', 'cost', 'stocks_value', 'coins_value', 'cash_value',
+                   'today_return_pct', 'total_return_pct')
+        query = db.select([cls.date, *(getattr(cls, c) for c in columns)]).order_by(cls.date)
+        if start:
+            query = query.where(cls.date >= start)
+        return read_frame(query).set_index('date')
+
     def calculate_etf(self, bond, stock):
         bond = next((pos for pos in self.positions if pos.symbol == bond), None)
         stock = next((pos for pos in self.positions if pos.symbol == stock), None)
@@ -94,8 +131,7 @@ class Portfolio(db.Model):
             return None
         equity, cost_today = bond.equity + stock.equity, bond.cost_today + stock.cost_today
         today_return_pct = (equity - cost_today) / cost_today
-        total_return_pct = (equity - bond.cost - stock.cost) / (
-                mean(bond.cost_timeline()) + mean(stock.cost_timeline()))
+        total_return_pct = (equity - bond.cost - stock.cost) / (bond.average_cost + stock.average_cost)
         return f'{today_return_pct * 100:+.2f}%/{total_return_pct * 100:+.2f}%'
 
 
@@ -130,19 +166,25 @@ class Order(db.Model):
 
     @classmethod
     def create_or_update(cls, id, instrument, executed_at, price, quantity, fees, side):
+        values = cls.parse(id, instrument, executed_at, price, quantity, fees, side)
         inst = cls.query.get(id)
         if not inst:
             inst = cls(id=id)
             inst.instrument = instrument
             db.session.add(inst)
-        inst.executed_at = datetime.fromisoformat(executed_at.replace('Z', '+00:00'))
-        inst.price = float(price)
-        inst.quantity = float(quantity)
-        inst.fees = float(fees)
-        sign = +1 if side == 'buy' else -1
-        inst.amount = round(sign * inst.price * inst.quantity + inst.fees, 2)
+        for k, v in values.items():
+            setattr(inst, k, v)
         return inst
 
+    @staticmethod
+    def parse(id, instrument, executed_at, price, quantity, fees, side):
+        price, quantity, fees = float(price), float(quantity), float(fees)
+        sign = +1 if side == 'buy' else -1
+        return {'id': id, 'symbol': instrument.symbol,
+                'executed_at': datetime.fromisoformat(executed_at.replace('Z', '+00:00')),
+                'price': price, 'quantity': quantity, 'fees': fees,
+                'amount': round(sign * price * quantity + fees, 2)}
+
 
 class Dividend(db.Model):
     id = db.Column(db.String(40), primary_key=True)
@@ -161,17 +203,27 @@ class Dividend(db.Model):
 
     @classmethod
     def create_or_update(cls, id, instrument, amount, executed_at, rate, quantity):
+        values = cls.parse(id, instrument, amount, executed_at, rate, quantity)
         inst = cls.query.get(id)
         if not inst:
             inst = cls(id=id)
             inst.instrument = instrument
             db.session.add(inst)
-        inst.amount = float(amount)
-        inst.executed_at = datetime.fromisoformat(executed_at.replace('Z', '+00:00'))
-        inst.rate = float(rate)
-        inst.quantity = float(quantity)
+        for k, v in values.items():
+            setattr(inst, k, v)
         return inst
 
+    @staticmethod
+    def parse(id, instrument, amount, executed_at, rate, quantity):
+        return {'id': id, 'symbol': instrument.symbol, 'amount': float(amount),
+                'executed_at': datetime.fromisoformat(executed_at.replace('Z', '+00:00')),
+                'rate': float(rate), 'quantity': float(quantity)}
+
+
+PositionPreload = collections.namedtuple('PositionPreload', 'orders dividends positions')
+RobinhoodRecords = collections.namedtuple('RobinhoodRecords',
+                                          'transfers stocks coins crypto_orders stock_orders dividends positions')
+
 
 class Position(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -185,6 +237,9 @@ class Position(db.Model):
     current_price = db.Column(db.Float, nullable=False)
     today_return_pct = db.Column(db.Float)
     total_return_pct = db.Column(db.Float)
+    # running aggregates of cost over the days with positive equity, carried forward from previous
+    cost_sum = db.Column(db.Float)
+    cost_count = db.Column(db.Integer)
     last_update = db.Column(db.DateTime)
     # relationship
     previous_id = db.Column(db.Integer, db.ForeignKey('position.id'))
@@ -198,11 +253,13 @@ class Position(db.Model):
             f' | {self.today_return_pct}%/{self.total_return_pct}%'
 
     @classmethod
-    def create_or_update(cls, instrument, previous, portfolio, quantity):
-        orders = Order.query.filter_by(instrument=instrument, position=None).all()
-        dividends = Dividend.query.filter_by(instrument=instrument, position=None).all()
+    def create_or_update(cls, instrument, previous, portfolio, quantity, preloaded=None):
         today = date.today()
-        inst = cls.query.filter_by(instrument=instrument, date=today).first()
+        if preloaded is None:
+            preloaded = cls.preload(today, instrument.symbol)
+        orders = preloaded.orders.get(instrument.symbol, [])
+        dividends = preloaded.dividends.get(instrument.symbol, [])
+        inst = preloaded.positions.get(instrument.symbol)
         if not inst:
             if previous and previous.quantity == 0:
                 previous = None
@@ -220,7 +277,8 @@ class Position(db.Model):
         inst.today_return_pct = round((inst.equity - inst.cost_today) /
                                       (inst.cost_today if inst.equity > 0 else
                                        (inst.previous.equity if inst.previous else 0)) * 100, 2)
-        inst.total_return_pct = round((inst.equity - inst.cost) / mean(inst.cost_timeline()) * 100, 2)
+        inst.accumulate_cost()
+        inst.total_return_pct = round((inst.equity - inst.cost) / inst.average_cost * 100, 2)
         inst.last_update = datetime.utcnow()
         return inst
 
@@ -229,6 +287,15 @@ class Position(db.Model):
         prev_equity, prev_cost = (self.previous.equity, self.previous.cost) if self.previous else (0, 0)
         return prev_equity + self.cost - prev_cost
 
+    def accumulate_cost(self):
+        prev_sum, prev_count = (self.previous.cost_sum, self.previous.cost_count) if self.previous else (0, 0)
+        self.cost_sum = round(prev_sum + (self.cost if self.equity > 0 else 0), 2)
+        self.cost_count = prev_count + (1 if self.equity > 0 else 0)
+
+    @property
+    def average_cost(self):
+        return self.cost_sum / self.cost_count
+
     def cost_timeline(self):
         cur = self
         while cur:
@@ -236,87 +303,247 @@ class Position(db.Model):
                 yield cur.cost
             cur = cur.previous
 
+    @classmethod
+    def preload(cls, today, symbol=None):
+        # unassigned orders and dividends plus today's rows (with theirs), grouped by symbol, in five queries
+        orders, dividends = Order.query.filter_by(position=None), Dividend.query.filter_by(position=None)
+        positions = cls.query.filter_by(date=today).options(selectinload(cls.orders), selectinload(cls.dividends))
+        if symbol:
+            orders, dividends = orders.filter_by(symbol=symbol), dividends.filter_by(symbol=symbol)
+            positions = positions.filter_by(symbol=symbol)
+        preloaded = PositionPreload(collections.defaultdict(list), collections.defaultdict(list),
+                                    {pos.symbol: pos for pos in positions})
+        for o in orders:
+            preloaded.orders[o.symbol].append(o)
+        for d in dividends:
+            preloaded.dividends[d.symbol].append(d)
+        return preloaded
+
+    @classmethod
+    def history(cls, symbols=None, start=None):
+        # date x (field, symbol), so history()['equity'] is one column per symbol; days without a position are NaN
+        columns = ('equity', 'cost', 'quantity', 'today_return_pct', 'total_return_pct')
+        query = db.select([cls.date, cls.symbol, *(getattr(cls, c) for c in columns)]).order_by(cls.date)
+        if symbols:
+            query = query.where(cls.symbol.in_(symbols))
+        if start:
+            query = query.where(cls.date >= start)
+        return read_frame(query).pivot(index='date', columns='symbol', values=list(columns))
+
     @property
     def percentage_of_portfolio(self):
         # return round(self.equity / (self.portfolio.stocks_value + self.portfolio.coins_value) * 100, 2)
-        return round(self.equity / (self.portfolio.equity + MARGIN_LIMIT) * 100, 2)
+        return round(self.equity / (self.portfolio.equity + margin_limit()) * 100, 2)
+
 
+def read_frame(query):
+    # plain rows straight from the cursor into one frame, through the session's connection so pending writes are
+    # visible
+    import pandas as pd
+    return pd.read_sql(query, db.session.connection(), parse_dates=['date'])
 
-def update_rh_account():
+
+def paginate(rh, url, since=None, timestamp=None):
+    # follows `next` cursors of a newest-first listing, until the first record older than `since`
+    while url:
+        json = rh.get(url).json()
+        for record in json['results']:
+            ts = since and timestamp(record)
+            if ts and parse_timestamp(ts) < since:
+                return
+            yield record
+        url = json.get('next')
+
+
+def fetch_all(rh, url, since=None, timestamp=None):
+    return list(paginate(rh, url, since, timestamp))
+
+
+def updated_since(url, since):
+    # The listing is ordered by created_at, but an order created long before the watermark (a limit or gtc order)
+    # can fill after it: the api filters on updated_at instead, which moves when the order fills.
+    return f"{url}?{urlencode({'updated_at[gte]': since.isoformat() + 'Z'})}" if since else url
+
+
+def fetch_json(rh, url):
+    return rh.get(url).json()
+
+
+def instrument_id(url):
+    return url[len('https://api.robinhood.com/instruments/'):-1]
+
+
+def parse_timestamp(ts):
+    return datetime.fromisoformat(ts.replace('Z', '+00:00')).astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def watermark(column, *criterion, full=False):
+    # records are re-fetched from a week before the newest one stored, to pick up late fills and settlements
+    newest = None if full else db.session.query(func.max(column)).filter(*criterion).scalar()
+    return newest - SYNC_LOOKBACK if newest else None
+
+
+def update_rh_account(full=False):
+    apply_rh_account(fetch_rh_account(full))
+
+
+def fetch_rh_account(full=False):
+    # Reads only, the endpoints don't depend on each other so they are fetched concurrently; apply_rh_account does
+    # all the writes, in order, on one thread
+    rh = db.get_app().robinhood
+    with ThreadPoolExecutor(max_workers=7) as pool:
+        transfers = pool.submit(fetch_all, rh, 'https://api.robinhood.com/ach/transfers/',
+                                watermark(Transfer.created_at, full=full), lambda r: r['created_at'])
+        stocks = pool.submit(fetch_json, rh, 'https://api.robinhood.com/portfolios/')
+        coins = pool.submit(fetch_json, rh, 'https://nummus.robinhood.com/portfolios/')
+        crypto_orders = pool.submit(fetch_all, rh, 'https://nummus.robinhood.com/orders/',
+                                    watermark(Order.executed_at, Order.symbol == 'BTC', full=full),
+                                    lambda r: r['created_at'])
+        stock_orders = pool.submit(fetch_all, rh, updated_since(
+            'https://api.robinhood.com/orders/', watermark(Order.executed_at, Order.symbol != 'BTC', full=full)))
+        dividends = pool.submit(fetch_all, rh, 'https://api.robinhood.com/dividends/',
+                                watermark(Dividend.executed_at, full=full), lambda r: r['paid_at'])
+        positions = pool.submit(fetch_all, rh, 'https://api.robinhood.com/positions/?nonzero=true')
+    return RobinhoodRecords(transfers.result(), stocks.result(), coins.result(), crypto_orders.result(),
+                            stock_orders.result(), dividends.result(), positions.result())
+
+
+def apply_rh_account(records):
     rh, logger = db.get_app().robinhood, db.get_app().logger
+    transfers, stocks, coins, crypto_orders, stock_orders, dividends, positions = records
+    referenced = {instrument_id(r['instrument']) for r in (*stock_orders, *dividends, *positions)}
+    instruments = Instrument.identity_map(referenced)
+    for s in sorted(referenced - instruments.keys()):
+        logger.warning('Skipped the records of unknown instrument %s', s)
+
+    def instrument(record):
+        return instruments.get(instrument_id(record['instrument']))
 
     # Transfers
-    for trans in reversed(rh.get('https://api.robinhood.com/ach/transfers/').json()['results']):
-        Transfer.create_or_update(trans['id'], trans['created_at'], trans['direction'], trans['amount'])
+    bulk_upsert(Transfer, [Transfer.parse(trans['id'], trans['created_at'], trans['direction'], trans['amount'])
+                           for trans in reversed(transfers)])
 
     # Portfolio
     cost = db.session.query(func.sum(Transfer.amount)).scalar()
-    portfolio = Portfolio.create_or_update(cost)
+    portfolio = Portfolio.create_or_update(cost, stocks, coins)
     logger.info('%s', portfolio)
 
     # Orders
-    for order in reversed(rh.get('https://nummus.robinhood.com/orders/').json()['results']):
+    orders, btc = [], Instrument.query.get('BTC')
+    for order in reversed(crypto_orders):
         if order['state'] == 'filled':
-            Order.create_or_update(order['id'], Instrument.query.get('BTC'),
-                                   order['executions'][0]['timestamp'],
-                                   order['executions'][0]['effective_price'],
-                                   order['executions'][0]['quantity'],
-                                   0, order['side'])
-    for order in reversed(rh.get('https://api.robinhood.com/orders/').json()['results']):
-        if order['state'] == 'filled':
-            s = order['instrument'][len('https://api.robinhood.com/instruments/'):-1]
-            instrument = Instrument.query.filter_by(robinhood_id=s).first()
+            orders.append(Order.parse(order['id'], btc,
+                                      order['executions'][0]['timestamp'],
+                                      order['executions'][0]['effective_price'],
+                                      order['executions'][0]['quantity'],
+                                      0, order['side']))
+    for order in reversed(stock_orders):
+        if order['state'] == 'filled' and instrument(order):
             amount, quantity = 0, 0
             for exe in order['executions']:
                 amount += float(exe['price']) * float(exe['quantity'])
                 quantity += float(exe['quantity'])
-            Order.create_or_update(order['id'], instrument,
-                                   order['executions'][-1]['timestamp'],
-                                   round(amount / quantity, 4), quantity,
-                                   order['fees'], order['side'])
+            orders.append(Order.parse(order['id'], instrument(order),
+                                      order['executions'][-1]['timestamp'],
+                                      round(amount / quantity, 4), quantity,
+                                      order['fees'], order['side']))
+    bulk_upsert(Order, orders)
 
     # Dividends
-    for dividend in reversed(rh.get('https://api.robinhood.com/dividends/').json()['results']):
-        if dividend['state'] == 'paid':
-            s = dividend['instrument'][len('https://api.robinhood.com/instruments/'):-1]
-            instrument = Instrument.query.filter_by(robinhood_id=s).first()
-            Dividend.create_or_update(dividend['id'], instrument,
-                                      dividend['amount'], dividend['paid_at'],
-                                      dividend['rate'], dividend['position'])
+    bulk_upsert(Dividend, [Dividend.parse(dividend['id'], instrument(dividend),
+                                          dividend['amount'], dividend['paid_at'],
+                                          dividend['rate'], dividend['position'])
+                           for dividend in reversed(dividends)
+                           if dividend['state'] == 'paid' and instrument(dividend)])
 
     # Positions
-    previous_positions = {pos.symbol: pos for pos in portfolio.previous.positions} if portfolio.previous else {}
+    previous_positions = {pos.symbol: pos for pos in Position.query.filter_by(portfolio_id=portfolio.previous_id)
+                          .options(selectinload(Position.instrument))} if portfolio.previous_id else {}
+    preloaded = Position.preload(portfolio.date)
+    fetch_prices(rh, [*filter(None, map(instrument, positions)),
+                      *(prev.instrument for prev in previous_positions.values())])
     # quantity = rh.get('https://nummus.robinhood.com/holdings/').json()['results'][0]['quantity']
     # instrument, previous = Instrument.query.get('BTC'), previous_positions.pop('BTC', None)
     # logger.info('%s', Position.create_or_update(instrument, previous, portfolio, quantity))
-    for pos in rh.get('https://api.robinhood.com/positions/?nonzero=true').json()['results']:
-        if float(pos['quantity']) > 0:
-            s = pos['instrument'][len('https://api.robinhood.com/instruments/'):-1]
-            instrument = Instrument.query.filter_by(robinhood_id=s).first()
-            previous = previous_positions.pop(instrument.symbol, None)
-            logger.info('%s', Position.create_or_update(instrument, previous, portfolio, pos['quantity']))
+    for pos in positions:
+        if float(pos['quantity']) > 0 and instrument(pos):
+            previous = previous_positions.pop(instrument(pos).symbol, None)
+            logger.info('%s', Position.create_or_update(instrument(pos), previous, portfolio, pos['quantity'],
+                                                        preloaded))
     if previous_positions:
         for prev in previous_positions.values():
             if prev.quantity > 0:
-                logger.info('%s', Position.create_or_update(prev.instrument, prev, portfolio, 0))
+                logger.info('%s', Position.create_or_update(prev.instrument, prev, portfolio, 0, preloaded))
 
     # ETF
     logger.info('1x ETF: %s', portfolio.calculate_etf('TLH', 'VIG'))
 
     # Recommendations
+    settings = PositionSetting.query.options(selectinload(PositionSetting.instrument)).all()
+    for trade in rebalance_portfolio(portfolio, settings):
+        logger.info('Recommendation: %s', trade)
     positions = {pos.symbol: pos for pos in portfolio.positions}
-    for setting in PositionSetting.query.all():
-        pos = positions.pop(setting.symbol, None)
-        diff = (portfolio.equity + MARGIN_LIMIT) * setting.proportion / 100 - (pos.equity if pos else 0)
-        if abs(diff) > (portfolio.equity + MARGIN_LIMIT) * .02:
-            logger.info('Recommendation: %s %+.1f (%.2f/%.2f)', setting.symbol,
-                        diff / setting.instrument.price, diff, setting.instrument.price)
+    for setting in settings:
+        pos = positions.get(setting.symbol)
         if pos:
             setting.profit_val = round(pos.equity - pos.cost, 2)
             setting.return_pct = pos.total_return_pct
-    if positions:
-        for pos in positions.values():
-            if pos.symbol != 'BTC' and pos.quantity > 0:
-                logger.info('Recommendation: %s %d (%.2f)', pos.symbol, -pos.quantity, -pos.equity)
 
     db.session.commit()
+
+
+def recompute_returns(symbols=None):
+    # Re-derives cost and returns of every stored day from the orders and dividends, e.g. after one was corrected
+    # or backfilled: one select per table, cumulative sums per previous_id chain, one bulk update per model.
+    logger = db.get_app().logger
+    flows = collections.defaultdict(float)
+    for model, sign in ((Order, +1), (Dividend, -1)):
+        query = db.session.query(model.position_id, func.sum(model.amount)).group_by(model.position_id)
+        for position_id, amount in query.filter(model.position_id.isnot(None)):
+            flows[position_id] += sign * amount
+
+    query = db.select([Position.id, Position.symbol, Position.date, Position.previous_id,
+                       Position.quantity, Position.equity]).order_by(Position.symbol, Position.date)
+    if symbols:
+        query = query.where(Position.symbol.in_(symbols))
+    positions = read_frame(query)
+    # a chain starts over whenever a position was closed and reopened, which leaves previous_id empty
+    segment = (positions['previous_id'].isnull() | (positions['symbol'] != positions['symbol'].shift())).cumsum()
+    positions['cost'] = positions['id'].map(flows).fillna(0).groupby(segment).cumsum().round(2)
+    positions['avg_buy_price'] = (positions['cost'] / positions['quantity']).where(positions['quantity'] > 0, 0) \
+        .round(2)
+    derive_returns(positions, segment)
+    db.session.bulk_update_mappings(Position, frame_records(positions, ('id', 'cost', 'avg_buy_price', 'cost_sum',
+                                                                          'cost_count', 'today_return_pct',
+                                                                          'total_return_pct')))
+    logger.info('Recomputed %d positions of %d symbols', len(positions), positions['symbol'].nunique())
+
+    if not symbols:
+        portfolios = read_frame(db.select([Portfolio.id, Portfolio.date, Portfolio.previous_id, Portfolio.cost,
+                                           Portfolio.equity]).order_by(Portfolio.date))
+        derive_returns(portfolios, portfolios['previous_id'].isnull().cumsum())
+        db.session.bulk_update_mappings(Portfolio, frame_records(portfolios, ('id', 'cost_sum', 'cost_count',
+                                                                              'today_return_pct',
+                                                                              'total_return_pct')))
+        logger.info('Recomputed %d portfolios', len(portfolios))
+    db.session.commit()
+
+
+def derive_returns(frame, segment):
+    # vectorized counterpart of create_or_update for rows with cost and equity set, ordered by date in each segment
+    import numpy as np
+    grouped = frame.groupby(segment)
+    prev_equity, prev_cost = grouped['equity'].shift(fill_value=0), grouped['cost'].shift(fill_value=0)
+    cost_today = prev_equity + frame['cost'] - prev_cost
+    held = frame['equity'] > 0
+    frame['cost_sum'] = frame['cost'].where(held, 0).groupby(segment).cumsum().round(2)
+    frame['cost_count'] = held.astype(int).groupby(segment).cumsum()
+    frame['today_return_pct'] = ((frame['equity'] - cost_today) / cost_today.where(held, prev_equity) * 100).round(2)
+    frame['total_return_pct'] = ((frame['equity'] - frame['cost'])
+                                 / (frame['cost_sum'] / frame['cost_count']) * 100).round(2)
+    frame.replace([np.inf, -np.inf], np.nan, inplace=True)
+
+
+def frame_records(frame, columns):
+    frame = frame[list(columns)].astype(object)
+    return frame.where(frame.notna(), None).to_dict('records')
@@ -1,30 +1,173 @@
+import inspect
 import math
 import os
 from datetime import date, timedelta, datetime
+from contextlib import contextmanager
+from functools import lru_cache, wraps
 
 import numpy as np
-import pandas_datareader.data as web
 import requests
-from pandas import DataFrame
-from scipy import linalg
-from scipy.optimize import minimize_scalar
-from sortedcontainers import SortedDict
+from pandas import DataFrame, concat
 
-RISK_FREE_RATE_PER_DAY = float(os.environ['RISK_FREE_RATE']) / 252
-DATA_READER = {
-    'yahoo': lambda symbols, start: web.DataReader(symbols, 'yahoo', start)['Adj Close'],
-    'tiingo': lambda symbols, start: web.DataReader(symbols, 'tiingo', start)['adjClose'].unstack('symbol'),
-}[os.environ['DATA_READER_VENDOR']]
+DATA_READERS = {
+    'yahoo': lambda web, symbols, start: web.DataReader(symbols, 'yahoo', start)['Adj Close'],
+    'tiingo': lambda web, symbols, start: web.DataReader(symbols, 'tiingo', start)['adjClose'].unstack('symbol'),
+}
+
+
+@lru_cache()
+def risk_free_rate_per_day():
+    return float(os.environ['RISK_FREE_RATE']) / 252
+
+
+def data_reader(symbols, start):
+    import pandas_datareader.data as web
+    return DATA_READERS[os.environ['DATA_READER_VENDOR']](web, symbols, start)
+
+
+def cached_result(method):
+    # Keeps the results of a slow search on disk, keyed by the content of the price window the quote holds, its
+    # period, the risk free rate and every argument: reruns return at once, changed prices miss. cache=False bypasses.
+    # The search runs with the quote's mask preserved, so a hit and a miss leave the quote in the same state.
+    signature = inspect.signature(method)
+
+    def run(self, *args, **kwargs):
+        with self.preserve_mask():
+            return method(self, *args, **kwargs)
+
+    @wraps(method)
+    def wrapper(self, *args, cache=True, **kwargs):
+        if not cache:
+            return run(self, *args, **kwargs)
+        from pandas.util import hash_pandas_object
+        from .cache import ResultCache
+        bound = signature.bind(self, *args, **kwargs)
+        bound.apply_defaults()
+        params = [(k, sorted(v) if isinstance(v, (set, frozenset)) else v) for k, v in bound.arguments.items()][1:]
+        store = ResultCache(method.__name__)
+        key = store.key(list(self.data.columns), hash_pandas_object(self.data).values.tobytes(), self.period,
+                        risk_free_rate_per_day(), params)
+        result = store.get(key)
+        return store.put(key, run(self, *args, **kwargs)) if result is store.MISSING else result
+
+    return wrapper
+
+
+def __getattr__(name):
+    # RISK_FREE_RATE_PER_DAY and DATA_READER used to be resolved at import time
+    if name == 'RISK_FREE_RATE_PER_DAY':
+        return risk_free_rate_per_day()
+    if name == 'DATA_READER':
+        return data_reader
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def downsample(data, width):
+    # two rows per each of `width` buckets holding the min and the max of every column, in the order they occur
+    size = math.ceil(len(data) / width)
+    if size <= 2:
+        return data
+    buckets = np.arange(len(data)) // size
+    frame = data.reset_index(drop=True).groupby(buckets)
+    low, high = frame.min(), frame.max()
+    low_first = (frame.idxmin() <= frame.idxmax()).values
+    starts = np.arange(0, len(data), size)
+    first = DataFrame(np.where(low_first, low, high), data.index[starts], data.columns)
+    last = DataFrame(np.where(low_first, high, low), data.index[np.minimum(starts + size, len(data)) - 1], data.columns)
+    return concat([first, last]).sort_index(kind='mergesort')
+
+
+def render_graph(data, name, formats, size, dpi):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    fig, ax = plt.subplots(figsize=(size[0] / dpi, size[1] / dpi), dpi=dpi)
+    try:
+        data.plot(ax=ax, grid=1)
+        fig.tight_layout()
+        for fmt in formats:
+            fig.savefig(f'{name}.{fmt}', format=fmt)
+    finally:
+        plt.close(fig)
 
 
 class Quote:
-    def __init__(self, symbols, data_points, period):
-        start = DATA_READER('SPY', date.today() - timedelta(days=data_points * 1.5)).index[-data_points]
-        self.data = DATA_READER(symbols, start)
+    def __init__(self, symbols, data_points, period, data=None):
+        self.data = data if data is not None else data_reader(symbols, self.first_day(data_points))
         self.period = period
         self.start = self.data.index[0]
         self.end = self.data.index[-1]
         self.origin_data = None
+        self.views, self.returns = {}, None
+
+    @classmethod
+    def from_data(cls, data, period):
+        return cls(list(data.columns), len(data), period, data)
+
+    def view(self, data_points=None, period=None):
+        # The quote over the last `data_points` rows of these prices, optionally with another period, without another
+        # fetch: fetch once for the longest window and view the shorter ones. A view's frame is a slice of the same
+        # array, and a view asked for again comes back with its moving average already computed.
+        data_points, period = data_points or len(self.data), period or self.period
+        if data_points > len(self.data):
+            raise ValueError(f'{data_points} data points asked of a quote holding {len(self.data)}')
+        cached = self.views.get((data_points, period))
+        if cached is None or cached[0] is not self.data:
+            cached = self.views[data_points, period] = self.data, self.from_data(self.data.iloc[-data_points:], period)
+        return cached[1]
+
+    @staticmethod
+    def first_day(data_points):
+        return data_reader('SPY', date.today() - timedelta(days=data_points * 1.5)).index[-data_points]
+
+    @classmethod
+    def stream_statistics(cls, symbols, data_points, period, top=20, key='shrp', where=None, batch_size=100):
+        # statistics() over any number of symbols (e.g. iter_securities pages) with the prices of at most two batches
+        # in memory: the next batch is fetched while the current one is scored. Keeps the `top` rows by `key`, plus
+        # every row `where` accepts. Heap entries carry a counter so equal keys never fall through to comparing rows.
+        import heapq
+        import itertools
+        from concurrent.futures import ThreadPoolExecutor
+        start, batches = cls.first_day(data_points), cls._rebatch(symbols, batch_size)
+
+        def fetch():
+            batch = next(batches, None)
+            return batch and data_reader(batch, start)
+
+        best, accepted, order = [], {}, itertools.count()
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            pending = pool.submit(fetch)
+            while True:
+                data = pending.result()
+                if data is None:
+                    break
+                pending = pool.submit(fetch)
+                stat = cls.from_data(data.dropna(axis=1, how='all'), period).statistics().dropna(subset=[key])
+                for symbol, row in stat.iterrows():
+                    if where and where(row):
+                        accepted[symbol] = row
+                    if len(best) < top:
+                        heapq.heappush(best, (row[key], symbol, next(order), row))
+                    elif row[key] > best[0][0]:
+                        heapq.heapreplace(best, (row[key], symbol, next(order), row))
+        rows = {**{symbol: row for _, symbol, _, row in best}, **accepted}
+        return DataFrame(rows.values(), index=list(rows)).sort_values(key, ascending=False)
+
+    @staticmethod
+    def _rebatch(pages, batch_size):
+        # symbols repeated across pages are only fetched once
+        batch, seen = [], set()
+        for page in pages:
+            for symbol in ([page] if isinstance(page, str) else page):
+                if symbol in seen:
+                    continue
+                seen.add(symbol)
+                batch.append(symbol)
+                if len(batch) == batch_size:
+                    yield batch
+                    batch = []
+        if batch:
+            yield batch
 
     def setup_mask(self, mask):
         if self.origin_data is None:
@@ -35,20 +178,32 @@ class Quote:
         if self.origin_data is not None:
             self.data, self.origin_data = self.origin_data, None
 
+    @contextmanager
+    def preserve_mask(self):
+        data, origin_data = self.data, self.origin_data
+        try:
+            yield self
+        finally:
+            self.data, self.origin_data = data, origin_data
+
     def moving_average(self):
-        return self.data.rolling(self.period, self.period - 1).mean().pct_change() * 100
+        # computed once per frame and period, a mask or a new frame recomputes it
+        if self.returns is None or self.returns[0] is not self.data or self.returns[1] != self.period:
+            returns = self.data.rolling(self.period, self.period - 1).mean().pct_change() * 100
+            self.returns = self.data, self.period, returns
+        return self.returns[2]
 
     def statistics(self):
         data = self.moving_average()
         frame = {'len': data.count(), 'mean': data.mean(), 'std': data.std(), 'skew': data.skew(),
-                 'shrp': (data.mean() - RISK_FREE_RATE_PER_DAY) / data.std(),
+                 'shrp': (data.mean() - risk_free_rate_per_day()) / data.std(),
                  'yield': self.data.T[self.data.index[-1]] / self.data.T[self.data.index[0]] * 100 - 100,
                  'drawdown': self.data.apply(self._max_drawdown)}
         return DataFrame(frame).sort_values('shrp', ascending=False)
 
     def update_boosts(self, instruments):
         r = self.moving_average()
-        boosts = 2 ** ((r.mean() - RISK_FREE_RATE_PER_DAY) / r.std() - .8)
+        boosts = 2 ** ((r.mean() - risk_free_rate_per_day()) / r.std() - .8)
         for sym, inst in instruments.items():
             inst.boost = round(boosts[sym], 4)
             if inst.is_china():
@@ -57,7 +212,24 @@ class Quote:
                 inst.boost = 1
             inst.boost_last_update = datetime.utcnow()
 
-    def least_correlated_portfolio(self, target, provided=None, *optional, cr=1, dr=1, sr=1):
+    def cluster_representatives(self, threshold=.1, keep=()):
+        # Groups the symbols by average linkage on the correlation distance 1 - corr, a cluster holding symbols
+        # within `threshold` of each other, and keeps the best sharpe ratio of each cluster (and `keep`).
+        from scipy.cluster.hierarchy import fcluster, linkage
+        from scipy.spatial.distance import squareform
+        data = self.moving_average()
+        if len(data.columns) < 2:
+            return list(data.columns)
+        dist = (1 - data.corr().fillna(0).values).clip(0, 2)
+        dist = (dist + dist.T) / 2
+        np.fill_diagonal(dist, 0)
+        clusters = fcluster(linkage(squareform(dist, checks=False), 'average'), threshold, criterion='distance')
+        shrp = ((data.mean() - risk_free_rate_per_day()) / data.std()).fillna(-np.inf)
+        best = shrp.groupby(clusters).idxmax()
+        return [s for s in data.columns if s in set(best) or s in keep]
+
+    @cached_result
+    def least_correlated_portfolio(self, target, provided=None, *optional, cr=1, dr=1, sr=1, cluster=None):
         def dfs(i, ban):
             if buf:
                 coef = .1 * (len(buf) - 1)
@@ -80,6 +252,10 @@ class Quote:
                 dfs(j + 1, ban)
                 buf.pop()
 
+        if cluster:
+            with self.preserve_mask():
+                self.setup_mask(self.cluster_representatives(cluster, provided or ()))
+                return self.least_correlated_portfolio(target, provided, *optional, cr=cr, dr=dr, sr=sr, cache=False)
         stocks, corr, stat = self.data.columns, self.moving_average().corr(), self.statistics()
         buf = provided if provided else []
         best = [None, float('inf')]
@@ -94,15 +270,18 @@ class Quote:
     def optimize(self, target, total=1):
         data = self.moving_average()
         mean, cov, ones = data.mean(), data.cov(), np.ones(len(data.columns))
+        from scipy import linalg
         cov_inv = DataFrame(linalg.pinv(cov.values), cov.columns, cov.index)
         A, B, C = ones.T.dot(cov_inv).dot(mean), mean.T.dot(cov_inv).dot(mean), ones.T.dot(cov_inv).dot(ones)
         weights = (B * ones.T.dot(cov_inv) - A * mean.T.dot(cov_inv)) / (B * C - A * A) * total + (
                 C * mean.T.dot(cov_inv) - A * ones.T.dot(cov_inv)) / (B * C - A * A) * round(target, 3)
         m, s = weights.T.dot(mean), math.sqrt(weights.T.dot(cov).dot(weights))
-        r = (m - RISK_FREE_RATE_PER_DAY) / s
+        r = (m - risk_free_rate_per_day()) / s
         return {k: round(v, 3) for k, v in weights.items()}, round(m, 3), round(s, 3), round(r, 3)
 
     def find_optimal_ratio(self, _lambda=0, bounds=None, total=1):
+        from scipy import linalg
+        from scipy.optimize import minimize_scalar
         assert -2 <= _lambda <= 2
 
         def attempt(guess):
@@ -132,9 +311,16 @@ class Quote:
             print(res)
         return self.optimize(res.x, total)
 
+    @cached_result
     def optimize_portfolio(self, min_percent=.2, max_count=5,
                            backlogs_pos_threshold=.9, backlogs_neg_threshold=-.5, _lambda=0, bounds=None,
-                           must_have=frozenset()):
+                           must_have=frozenset(), cluster=None):
+        from sortedcontainers import SortedDict
+        if cluster:
+            with self.preserve_mask():
+                self.setup_mask(self.cluster_representatives(cluster, must_have))
+                return self.optimize_portfolio(min_percent, max_count, backlogs_pos_threshold, backlogs_neg_threshold,
+                                               _lambda, bounds, must_have, cache=False)
         candidates, backlogs = set(self.data.columns), []
         corr = self.moving_average().corr()
         while len(candidates) > 1:
@@ -149,7 +335,7 @@ class Quote:
                         nxt1 = backlogs_pos_threshold + .001
                     print(f'retry backlogs {backlogs} at {nxt1:.3f}/{nxt2:.2f} - {shrp}')
                     self.setup_mask([*backlogs, *candidates])
-                    sd = self.optimize_portfolio(min_percent, max_count, nxt1, nxt2, _lambda, bounds)
+                    sd = self.optimize_portfolio(min_percent, max_count, nxt1, nxt2, _lambda, bounds, cache=False)
                     if bounds and bounds[0] <= mean <= bounds[1]:
                         sd[(coef, shrp, mean)] = ratio
                         while sd.peekitem(0)[0] < (coef * .9, shrp, mean):
@@ -171,7 +357,7 @@ class Quote:
                 nxt1 = backlogs_pos_threshold + .001
             print(f'retry backlogs {backlogs} at {nxt1:.3f}/{nxt2:.2f} - {shrp}')
             self.setup_mask([*backlogs, candidate])
-            sd = self.optimize_portfolio(min_percent, max_count, nxt1, nxt2, _lambda, bounds)
+            sd = self.optimize_portfolio(min_percent, max_count, nxt1, nxt2, _lambda, bounds, cache=False)
             if bounds and bounds[0] <= mean <= bounds[1]:
                 sd[(coef, shrp, mean)] = {candidate: 1}
                 while sd.peekitem(0)[0] < (coef * .9, shrp, mean):
@@ -179,11 +365,96 @@ class Quote:
             return sd
         return SortedDict([((coef, shrp, mean), {candidate: 1})])
 
+    def optimize_constrained(self, min_percent=.2, max_count=5, max_percent=1, _lambda=0, total=1,
+                             must_have=frozenset()):
+        # Long-only counterpart of optimize_portfolio: one projected gradient solve of the find_optimal_ratio
+        # objective s / m ** (1 + _lambda / 5) with 0 <= weight <= max_percent, must_have names held at min_percent
+        # at least. The max_count largest weights (and must_have) are kept, then the smallest weight under
+        # min_percent is dropped until none is left, re-solving each time on the few survivors.
+        assert -2 <= _lambda <= 2
+        data = self.moving_average()
+        mean, cov = data.mean(), data.cov()
+        if min(max_count, len(mean)) * max_percent < total:
+            raise ValueError(f'{min(max_count, len(mean))} positions of at most {max_percent} cannot make up {total}')
+        protected, keep = mean.index.isin(list(must_have)), np.ones(len(mean), dtype=bool)
+        lower = np.where(protected, min(max(min_percent, .001), max_percent), 0)
+        if np.count_nonzero(protected) > max_count or lower.sum() > total:
+            raise ValueError(f'{np.count_nonzero(protected)} must have positions of at least {lower.max()} '
+                             f'do not fit in {max_count} positions making up {total}')
+        while True:
+            weights = np.zeros(len(mean))
+            weights[keep] = self._long_only_weights(mean.values[keep], cov.values[np.ix_(keep, keep)],
+                                                    _lambda, max_percent, total, lower[keep])
+            keep &= (weights > 1e-6) | protected
+            if np.count_nonzero(keep) > max_count:
+                keep[np.argsort(-(weights + protected * total))[max_count:]] = False
+                continue
+            small = keep & ~protected & (weights < min_percent)
+            if not small.any() or (np.count_nonzero(keep) - 1) * max_percent < total:
+                break
+            keep[np.argmin(np.where(small, weights, np.inf))] = False
+        weights[~keep] = 0
+        m, s = weights.dot(mean.values), math.sqrt(weights.dot(cov.values).dot(weights))
+        r = (m - risk_free_rate_per_day()) / s
+        return {k: round(v, 3) for k, v in zip(mean.index, weights) if v > 0}, round(m, 3), round(s, 3), round(r, 3)
+
+    @staticmethod
+    def _long_only_weights(mean, cov, _lambda, upper, total, lower=0, iterations=1000, tol=1e-12):
+        # minimizes log(s) - power * log(m) on the capped simplex, with a backtracking step; without any positive
+        # mean the return term is dropped and this is the minimum variance portfolio
+        power = 1 + _lambda / 5 if (mean > 0).any() else 0
+        if len(mean) * upper < total:
+            raise ValueError(f'{len(mean)} positions of at most {upper} cannot make up {total}')
+        lower = np.broadcast_to(lower, len(mean))
+
+        def objective(w):
+            m = w.dot(mean)
+            if power and m <= 0:
+                return math.inf
+            return math.log(max(w.dot(cov).dot(w), 1e-300)) / 2 - (power * math.log(m) if power else 0)
+
+        w = Quote._project_capped_simplex(np.where(mean > 0, 1., 0.) if power else np.ones(len(mean)), upper, total,
+                                          lower)
+        f, step = objective(w), 1.
+        for _ in range(iterations):
+            v = cov.dot(w)
+            grad = v / max(w.dot(v), 1e-300) - (power * mean / w.dot(mean) if power else 0)
+            while True:
+                candidate = Quote._project_capped_simplex(w - step * grad, upper, total, lower)
+                fc = objective(candidate)
+                if fc <= f - 1e-4 * grad.dot(w - candidate) or step < 1e-12:
+                    break
+                step /= 2
+            if fc > f:
+                break
+            w, f, converged = candidate, fc, f - fc < tol
+            if converged:
+                break
+            step *= 2
+        return w
+
+    @staticmethod
+    def _project_capped_simplex(v, upper, total, lower=0):
+        # euclidean projection onto {lower <= w <= upper, sum(w) = total}: w = clip(v - tau), tau found by bisection
+        lo, hi = (v - upper).min(), (v - lower).max()
+        for _ in range(100):
+            tau = (lo + hi) / 2
+            if np.clip(v - tau, lower, upper).sum() > total:
+                lo = tau
+            else:
+                hi = tau
+        return np.clip(v - (lo + hi) / 2, lower, upper)
+
     def _calculate_sharpe_ratio(self, stock):
         data = self.moving_average()[stock]
-        return round(data.mean(), 3), round((data.mean() - RISK_FREE_RATE_PER_DAY) / data.std(), 3)
+        return round(data.mean(), 3), round((data.mean() - risk_free_rate_per_day()) / data.std(), 3)
 
     def graph(self, portfolio=None, drop_components=False):
+        data = self.graph_data(portfolio, drop_components)
+        data.plot(figsize=(15, 5), grid=1)
+        return self.graph_stats(data)
+
+    def graph_data(self, portfolio=None, drop_components=False):
         data = {col: self.data[col] * (100 / self.data[col][self.start]) for col in self.data.columns}
         if portfolio:
             data['Portfolio'] = sum(data[st] * sh for st, sh in portfolio.items())
@@ -191,16 +462,36 @@ class Quote:
             if drop_components:
                 for st in portfolio:
                     del data[st]
-        data = DataFrame(data)
-        data.plot(figsize=(15, 5), grid=1)
+        return DataFrame(data)
+
+    def graph_stats(self, data):
         dd = data.rolling(self.period, self.period - 1).mean().pct_change() * 100
         stat = dd.describe().T
-        stat['shrp'] = (stat['mean'] - RISK_FREE_RATE_PER_DAY) / stat['std']
+        stat['shrp'] = (stat['mean'] - risk_free_rate_per_day()) / stat['std']
         stat['yield'] = data.T[data.index[-1]] / data.T[data.index[0]] * 100 - 100
         stat['drawdown'] = data.apply(self._max_drawdown)
         stat['skewness'] = dd.skew()
         return stat.sort_values('shrp', ascending=False)
 
+    def export_graphs(self, portfolios, path, formats=('png',), size=(1500, 500), dpi=100, drop_components=False,
+                      workers=None):
+        # Renders the graph of every portfolio (name -> weights, None for the bare components) headless across a
+        # process pool, writing <name>.<format> for each format and <name>.csv with its stats. The series are cut
+        # down to their min and max per pixel column first, which looks the same at that width.
+        from concurrent.futures import ProcessPoolExecutor
+        os.makedirs(path, exist_ok=True)
+        stats, jobs = {}, []
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for name, portfolio in portfolios.items():
+                data = self.graph_data(portfolio, drop_components)
+                stats[name] = self.graph_stats(data)
+                stats[name].to_csv(os.path.join(path, f'{name}.csv'))
+                jobs.append(pool.submit(render_graph, downsample(data, size[0]), os.path.join(path, name), formats,
+                                        size, dpi))
+            for job in jobs:
+                job.result()
+        return stats
+
     @staticmethod
     def _max_drawdown(series):
         max_price_so_far, max_drawdown_so_far = float('-inf'), 0
@@ -215,6 +506,7 @@ class Quote:
 
     @staticmethod
     def usd_cny():
+        import pandas_datareader.data as web
         print(web.DataReader('USD/CNY', 'av-forex')['USD/CNY']['Exchange Rate'])
 
     @staticmethod
@@ -230,24 +522,22 @@ class Quote:
 
     @staticmethod
     def screen_securities(min_assets=100, min_ratio=None, max_ratio=100):
-        def screen(after=None):
-            variables = {'limit': [{'type': 'MARKET_CAP', 'min': min_assets * 1000000000, 'inclusive': True},
-                                   {'type': 'PE_RATIO', 'min': min_ratio, 'max': max_ratio, 'inclusive': True}],
-                         'after': after}
-            r = requests.post('https://lens.m1finance.com/graphql',
-                              json={'query': query, 'variables': variables}).json()
-            cursor = None
-            if r['data']['viewer']['screenSecurities']['pageInfo']['hasNextPage']:
-                cursor = r['data']['viewer']['screenSecurities']['pageInfo']['endCursor']
-            return [n['node']['symbol'].replace('.', '-')
-                    for n in r['data']['viewer']['screenSecurities']['edges']], cursor
+        return [s for page in Quote.iter_securities(min_assets, min_ratio, max_ratio) for s in page]
 
+    @staticmethod
+    def iter_securities(min_assets=100, min_ratio=None, max_ratio=100):
+        # screen_securities one page of (up to) 100 symbols at a time, requested as the previous one is consumed
         query = 'query screen($limit:[SecurityLimitOptionInput!]!,$after:String)' \
                 '{viewer{screenSecurities(filterTypes:EQUITY,limit:$limit,' \
                 'sort:{type:MARKET_CAP,direction:DESC},first:100,after:$after)' \
                 '{pageInfo{hasNextPage,endCursor},edges{node{symbol}}}}}'
-        s, after = screen()
-        while after:
-            ss, after = screen(after)
-            s += ss
-        return s
+        after, has_next = None, True
+        while has_next:
+            variables = {'limit': [{'type': 'MARKET_CAP', 'min': min_assets * 1000000000, 'inclusive': True},
+                                   {'type': 'PE_RATIO', 'min': min_ratio, 'max': max_ratio, 'inclusive': True}],
+                         'after': after}
+            r = requests.post('https://lens.m1finance.com/graphql',
+                              json={'query': query, 'variables': variables}).json()
+            page = r['data']['viewer']['screenSecurities']
+            has_next, after = page['pageInfo']['hasNextPage'], page['pageInfo']['endCursor']
+            yield [n['node']['symbol'].replace('.', '-') for n in page['edges']]
@@ -0,0 +1,110 @@
+import os
+import tempfile
+import time
+
+from . import db
+
+WRITE_STATEMENTS = ('INSERT', 'UPDATE', 'DELETE')
+HEAVY_MODULES = ('numpy', 'pandas', 'scipy', 'pandas_datareader', 'sortedcontainers', 'matplotlib')
+
+
+class WriteTimer:
+    def __init__(self, engine, session):
+        self.elapsed, self._started = 0, None
+        self._listeners = [(engine, 'before_cursor_execute', self._before_execute),
+                           (engine, 'after_cursor_execute', self._after_execute),
+                           (session, 'before_commit', self._before_commit),
+                           (session, 'after_commit', self._after_commit)]
+
+    def __enter__(self):
+        from sqlalchemy import event
+        for target, name, fn in self._listeners:
+            event.listen(target, name, fn)
+        return self
+
+    def __exit__(self, *exc):
+        from sqlalchemy import event
+        for target, name, fn in self._listeners:
+            event.remove(target, name, fn)
+
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith(WRITE_STATEMENTS):
+            self._started = time.perf_counter()
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self._stop()
+
+    def _before_commit(self, session):
+        self._started = time.perf_counter()
+
+    def _after_commit(self, session):
+        self._stop()
+
+    def _stop(self):
+        if self._started is not None:
+            self.elapsed += time.perf_counter() - self._started
+            self._started = None
+
+
+def benchmark_sync(fixtures='fixtures', record=False, latency=0.05, popularity_cutoff=300):
+    # Runs a full instrument crawl and both account syncs against a throwaway sqlite database, replaying
+    # responses from `fixtures` (or recording them there from the live endpoints with record=True).
+    import requests
+    from . import create_app, m1
+    from .account import update_rh_account
+    from .instrument import update_instruments
+    from .m1 import update_m1_account
+    from .replay import use_fixtures
+
+    logger = db.get_app().logger
+    bench = create_app()
+    bench.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'benchmark')
+    bench.robinhood = requests.Session()
+    if record:
+        bench.robinhood.headers.update(db.get_app().robinhood.headers)
+    m1_client, m1.client = m1.client, m1.M1Client(persist=False)
+    adapters = [use_fixtures(bench.robinhood, fixtures, record, latency),
+                use_fixtures(m1.client.http, fixtures, record, latency)]
+    try:
+        with bench.app_context():
+            db.session.remove()  # the scoped session is per thread, drop the one bound to the calling app
+            db.create_all()
+            with WriteTimer(db.engine, db.session) as timer:
+                for name, job in (('instrument crawl', lambda: update_instruments(popularity_cutoff)),
+                                  ('robinhood account sync', update_rh_account),
+                                  ('m1 account sync', update_m1_account)):
+                    timer.elapsed, requests_before = 0, sum(a.count for a in adapters)
+                    started = time.perf_counter()
+                    job()
+                    wall = time.perf_counter() - started
+                    count = sum(a.count for a in adapters) - requests_before
+                    logger.info('%s: %d requests in %.2fs (%.1f req/s), db writes %.2fs',
+                                name, count, wall, count / wall, timer.elapsed)
+    finally:
+        m1.client = m1_client
+
+
+def benchmark_import(limit=1., runs=5):
+    # Guards the start-up cost of the account sync commands: a fresh interpreter creating the app and importing
+    # the sync modules must stay under `limit` seconds and must not pull in the scientific stack.
+    import subprocess
+    import sys
+    import click
+    code = ('import sys, time\n'
+            'started = time.perf_counter()\n'
+            'from app import create_app\n'
+            'create_app()\n'
+            'import app.account, app.instrument, app.m1\n'
+            'print(time.perf_counter() - started)\n'
+            f'print(",".join(m for m in {HEAVY_MODULES!r} if m in sys.modules))\n')
+    logger, timings = db.get_app().logger, []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, '-c', code], cwd=db.get_app().root_path,
+                             check=True, capture_output=True, text=True).stdout.split('\n')
+        timings.append(float(out[0]))
+        heavy = out[1]
+    logger.info('create_app + sync modules: best %.3fs, worst %.3fs over %d runs', min(timings), max(timings), runs)
+    if heavy:
+        raise click.ClickException(f'start-up imports {heavy}')
+    if min(timings) > limit:
+        raise click.ClickException(f'start-up took {min(timings):.3f}s, over the {limit:.3f}s limit')
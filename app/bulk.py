@@ -0,0 +1,77 @@
+from sqlalchemy import and_, bindparam
+
+from . import db
+
+CHUNK_SIZE = 500
+
+
+def bulk_upsert(model, records, key=None, chunk_size=CHUNK_SIZE):
+    # records are plain dicts of column values sharing the same keys, rows are matched on `key` (the primary key
+    # by default). It writes through the session's connection but skips the ORM, so objects of `model` already
+    # loaded in the session don't see the new values until they are expired or reloaded.
+    if not records:
+        return 0
+    table = model.__table__
+    key = tuple(key or (c.name for c in table.primary_key))
+    records = list({tuple(r[k] for k in key): r for r in records}.values())
+    insert = _on_conflict_insert(table, db.session.get_bind(model.__mapper__).dialect.name)
+    for i in range(0, len(records), chunk_size):
+        chunk = records[i:i + chunk_size]
+        if insert is not None:
+            stmt = insert(table)
+            update = {c: stmt.excluded[c] for c in chunk[0] if c not in key}
+            stmt = stmt.on_conflict_do_update(index_elements=key, set_=update) if update \
+                else stmt.on_conflict_do_nothing(index_elements=key)
+            db.session.execute(stmt, chunk)
+        else:
+            _select_then_write(table, key, chunk)
+    return len(records)
+
+
+def _on_conflict_insert(table, dialect):
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+        return insert
+    if dialect == 'sqlite':
+        try:  # sqlalchemy >= 1.4
+            from sqlalchemy.dialects.sqlite import insert
+            return insert
+        except ImportError:
+            return None
+    return None
+
+
+def _select_then_write(table, key, chunk):
+    cols = [table.c[k] for k in key]
+    keys = [tuple(r[k] for k in key) for r in chunk]
+    existing = _existing_keys(cols, keys)
+    inserts = [r for r, k in zip(chunk, keys) if k not in existing]
+    updates = [{**{c: v for c, v in r.items() if c not in key}, **{f'_{k}': r[k] for k in key}}
+               for r, k in zip(chunk, keys) if k in existing and len(r) > len(key)]
+    if inserts:
+        db.session.execute(table.insert(), inserts)
+    if updates:
+        db.session.execute(table.update().where(and_(*(c == bindparam(f'_{c.name}') for c in cols))), updates)
+
+
+def _existing_keys(cols, keys):
+    # narrow down by the first column only, composite IN isn't available on every dialect
+    query = db.select(cols).where(cols[0].in_(list({k[0] for k in keys})))
+    keys = set(keys)
+    return {k for k in (tuple(row) for row in db.session.execute(query)) if k in keys}
+
+
+def bulk_insert_missing(model, records, key, chunk_size=CHUNK_SIZE):
+    # insert-only counterpart of bulk_upsert for rows without a natural primary key, like tags
+    if not records:
+        return 0
+    table, count = model.__table__, 0
+    cols = [table.c[k] for k in key]
+    for i in range(0, len(records), chunk_size):
+        chunk = list({tuple(r[k] for k in key): r for r in records[i:i + chunk_size]}.items())
+        existing = _existing_keys(cols, [k for k, _ in chunk])
+        inserts = [r for k, r in chunk if k not in existing]
+        if inserts:
+            db.session.execute(table.insert(), inserts)
+            count += len(inserts)
+    return count
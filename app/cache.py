@@ -0,0 +1,69 @@
+import hashlib
+import os
+import pickle
+
+ROOT = os.path.abspath(os.path.dirname(__file__) + '/..')  # the app's root_path, usable without an app context
+
+
+def cache_dir(*parts):
+    # CACHE_DIR, cache/ in the project root by default, created on first use
+    path = os.path.join(os.environ.get('CACHE_DIR') or os.path.join(ROOT, 'cache'), *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+class ResultCache:
+    # Pickled results on disk, one file per key. A hit touches its file, so evicting by mtime once the directory
+    # grows over `max_bytes` drops the least recently used results first.
+    MISSING = object()
+
+    def __init__(self, name, max_bytes=None):
+        self.name = name
+        self.max_bytes = max_bytes or int(os.environ.get('RESULT_CACHE_BYTES', 256 * 1024 * 1024))
+
+    @staticmethod
+    def key(*parts):
+        digest = hashlib.sha1()
+        for part in parts:
+            digest.update(part if isinstance(part, bytes) else repr(part).encode())
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(cache_dir('results', self.name), key + '.pkl')
+
+    def get(self, key):
+        try:
+            with open(self.path(key), 'rb') as f:
+                value = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return self.MISSING
+        os.utime(self.path(key))
+        return value
+
+    def put(self, key, value):
+        tmp = self.path(key) + '.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump(value, f)
+        os.replace(tmp, self.path(key))
+        self.evict()
+        return value
+
+    def evict(self):
+        directory = cache_dir('results', self.name)
+        entries = []
+        for name in os.listdir(directory):
+            if name.endswith('.pkl'):
+                stat = os.stat(os.path.join(directory, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(os.path.join(directory, name))
+            total -= size
+
+    def clear(self):
+        directory = cache_dir('results', self.name)
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
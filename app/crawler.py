@@ -0,0 +1,136 @@
+import json
+import os
+import uuid
+from functools import lru_cache
+
+from flask import current_app, has_app_context
+
+from . import db
+from .instrument import Instrument, SEED_INSTRUMENTS, fetch_popularity
+
+# Crawl state lives in redis so any number of `flask work-instruments` processes can share it,
+# and a crashed or interrupted crawl picks up from the same frontier when started again.
+FRONTIER = 'crawl:instruments:frontier'  # list of robinhood ids waiting for a batch
+SEEN = 'crawl:instruments:seen'  # set of every robinhood id ever pushed to the frontier
+INFLIGHT = 'crawl:instruments:inflight'  # hash of batch id -> json list of robinhood ids
+COUNT = 'crawl:instruments:count'
+BATCH_SIZE = 50
+
+
+def redis_connection():
+    from redis import Redis
+    return Redis.from_url(os.environ.get('REDIS_URL', 'redis://localhost:6379/0'))
+
+
+def instruments_queue(connection, is_async=True):
+    from rq import Queue
+    return Queue('instruments', connection=connection, is_async=is_async, default_timeout=3600)
+
+
+@lru_cache()
+def worker_app():
+    # one app, hence one robinhood login, per worker process when jobs run outside `flask work-instruments`
+    from . import create_app
+    return create_app()
+
+
+def work_instruments(burst=False, connection=None):
+    # Runs the jobs in this process, inside the command's app context: every batch reuses the same app, robinhood
+    # session and database engine instead of a forked work horse logging in again per job.
+    from rq import SimpleWorker
+    conn = connection or redis_connection()
+    SimpleWorker([instruments_queue(conn)], connection=conn).work(burst=burst)
+
+
+def crawl_instruments(popularity_cutoff=300, restart=False, sync=False, connection=None):
+    logger = db.get_app().logger
+    conn = connection or redis_connection()
+    if restart:
+        conn.delete(FRONTIER, SEEN, INFLIGHT, COUNT)
+    if not conn.exists(SEEN):
+        Instrument.create_or_update_btc()
+        db.session.commit()
+        push_frontier(conn, SEED_INSTRUMENTS)
+        logger.info('Started a new crawl from %d seeds', len(SEED_INSTRUMENTS))
+    else:
+        logger.info('Resumed crawl: %d requeued batches, %d in frontier, %d seen, %d updated',
+                    requeue_inflight(conn), conn.llen(FRONTIER), conn.scard(SEEN), int(conn.get(COUNT) or 0))
+    queue = instruments_queue(conn, is_async=not sync)
+    logger.info('Enqueued %d batches', dispatch(conn, queue, popularity_cutoff))
+
+
+def push_frontier(conn, ids):
+    ids = list(dict.fromkeys(ids))
+    if not ids:
+        return 0
+    pipe = conn.pipeline()
+    for s in ids:
+        pipe.sadd(SEEN, s)
+    new = [s for s, added in zip(ids, pipe.execute()) if added]
+    if new:
+        conn.rpush(FRONTIER, *new)
+    return len(new)
+
+
+def pop_batch(conn):
+    batch_id, chunk = uuid.uuid4().hex, []
+
+    def take(pipe):
+        chunk[:] = [s.decode() for s in pipe.lrange(FRONTIER, 0, BATCH_SIZE - 1)]
+        pipe.multi()
+        if chunk:
+            pipe.ltrim(FRONTIER, len(chunk), -1)
+            pipe.hset(INFLIGHT, batch_id, json.dumps(chunk))
+
+    conn.transaction(take, FRONTIER)
+    return (batch_id, chunk) if chunk else (None, None)
+
+
+def dispatch(conn, queue, popularity_cutoff):
+    count = 0
+    while True:
+        batch_id, chunk = pop_batch(conn)
+        if not chunk:
+            return count
+        # workers chain the follow-up batches themselves, a synchronous queue is drained by this loop instead
+        queue.enqueue(crawl_batch, batch_id, chunk, popularity_cutoff, queue.is_async, job_id=batch_id)
+        count += 1
+
+
+def requeue_inflight(conn):
+    from rq.exceptions import NoSuchJobError
+    from rq.job import Job
+    count = 0
+    for batch_id, chunk in conn.hgetall(INFLIGHT).items():
+        try:
+            status = Job.fetch(batch_id.decode(), connection=conn).get_status()
+        except NoSuchJobError:
+            status = None
+        if status in ('queued', 'started', 'deferred', 'scheduled'):
+            continue
+        pipe = conn.pipeline()
+        pipe.lpush(FRONTIER, *reversed(json.loads(chunk)))
+        pipe.hdel(INFLIGHT, batch_id)
+        pipe.execute()
+        count += 1
+    return count
+
+
+def crawl_batch(batch_id, chunk, popularity_cutoff, chain=True):
+    if not has_app_context():
+        with worker_app().app_context():
+            return crawl_batch(batch_id, chunk, popularity_cutoff, chain)
+
+    from rq import get_current_job
+    rh, logger = current_app.robinhood, current_app.logger
+    job = get_current_job()
+    conn = job.connection if job else redis_connection()
+    recommended = []
+    for values in Instrument.bulk_create_or_update(fetch_popularity(rh, chunk, popularity_cutoff), recommended):
+        logger.info('%d. %s', conn.incr(COUNT), Instrument.describe(values))
+    db.session.commit()
+    db.session.remove()  # the session outlives the job in a long running worker, start each batch afresh
+    push_frontier(conn, recommended)
+    conn.hdel(INFLIGHT, batch_id)
+    if chain:
+        dispatch(conn, instruments_queue(conn), popularity_cutoff)
@@ -1,4 +1,5 @@
-from datetime import datetime, date
+import math
+from datetime import datetime, date, timedelta
 
 from werkzeug.utils import cached_property
 
@@ -12,6 +13,7 @@ class Instrument(db.Model):
     list_date = db.Column(db.Date, nullable=False)
     popularity = db.Column(db.Integer, nullable=False)
     last_update = db.Column(db.DateTime, nullable=False)
+    refresh_popularity = db.Column(db.Integer)  # popularity as of last_update
     # fundamentals
     description = db.Column(db.String(2048))
     sector = db.Column(db.String(40))
@@ -28,7 +30,7 @@ class Instrument(db.Model):
     headquarters_state = db.Column(db.String(40))
     num_employees = db.Column(db.Integer)
     year_founded = db.Column(db.Integer)
-    boost = db.Column(db.Float)
+    boost = db.Column(db.Float, default=1)
     boost_last_update = db.Column(db.DateTime)
     # relationship
     tags = db.relationship('Tag')
@@ -36,14 +38,18 @@ class Instrument(db.Model):
     def __str__(self):
         return f'[{self.symbol}] {self.name} ({self.sector}) {self.popularity}'
 
+    @staticmethod
+    def describe(values):
+        # the log line of a row given as a dict of column values, without building a throwaway instrument
+        return f"[{values.get('symbol')}] {values.get('name')} ({values.get('sector')}) {values.get('popularity')}"
+
     @classmethod
     def create_or_update(cls, rid, popularity=None, recommended=None):
-        rh = db.get_app().robinhood
-        json = rh.get(f'https://api.robinhood.com/instruments/{rid}/').json()
-        if not json.get('tradeable') or not json['list_date'] or json['state'] == 'unlisted':
+        values, tags = cls.fetch(rid, popularity, recommended)
+        if not values:
             return None
 
-        symbol = json['symbol']
+        symbol = values['symbol']
         inst = cls.query.get(symbol)
         if not inst:
             old = cls.query.filter_by(robinhood_id=rid).first()
@@ -51,47 +57,97 @@ class Instrument(db.Model):
                 db.session.delete(old)
             inst = cls(symbol=symbol, boost=1)
             db.session.add(inst)
+        for k, v in values.items():
+            setattr(inst, k, v)
+        for name in tags:
+            if not any(t.name == name for t in inst.tags):
+                inst.tags.append(Tag(symbol=symbol, name=name))
+        return inst
 
-        inst.robinhood_id = json['id']
-        inst.name = json['simple_name'] or json['name']
-        inst.list_date = datetime.strptime(json['list_date'], '%Y-%m-%d')
-        inst.last_update = datetime.utcnow()
-        if popularity is not None:
-            inst.popularity = popularity
-        else:
+    @classmethod
+    def bulk_create_or_update(cls, popularity, recommended=None, tradeable_only=True):
+        from .bulk import bulk_upsert, bulk_insert_missing
+        records, tags = [], []
+        for rid, p in popularity.items():
+            values, names = cls.fetch(rid, p, recommended, tradeable_only)
+            if values:
+                records.append(values)
+                tags.extend({'symbol': values['symbol'], 'name': name} for name in names)
+        if not records:
+            return []
+        cls.query.filter(cls.robinhood_id.in_([r['robinhood_id'] for r in records]),
+                         ~cls.symbol.in_([r['symbol'] for r in records])).delete(synchronize_session=False)
+        bulk_upsert(cls, records)
+        bulk_insert_missing(Tag, tags, ('symbol', 'name'))
+        return records
+
+    @classmethod
+    def fetch(cls, rid, popularity=None, recommended=None, tradeable_only=True):
+        rh = db.get_app().robinhood
+        json = rh.get(f'https://api.robinhood.com/instruments/{rid}/').json()
+        if not json.get('list_date') or tradeable_only and (not json.get('tradeable') or json['state'] == 'unlisted'):
+            return None, None
+
+        values = {'symbol': json['symbol'], 'robinhood_id': json['id'], 'name': json['simple_name'] or json['name'],
+                  'list_date': datetime.strptime(json['list_date'], '%Y-%m-%d'), 'last_update': datetime.utcnow()}
+        if popularity is None:
             json = rh.get(f'https://api.robinhood.com/instruments/popularity/?ids={rid}').json()
-            inst.popularity = int(json['results'][0]['num_open_positions'])
-        inst.fill_fundamentals(rh.get(f'https://api.robinhood.com/fundamentals/{rid}/').json())
+            popularity = int(json['results'][0]['num_open_positions'])
+        values['popularity'] = values['refresh_popularity'] = popularity
+        values.update(cls.parse_fundamentals(rh.get(f'https://api.robinhood.com/fundamentals/{rid}/').json()))
 
         if recommended is not None:
             json = rh.get(f'https://dora.robinhood.com/instruments/similar/{rid}/').json()
             recommended.extend(s['instrument_id'] for s in json['similar'])
         json = rh.get(f'https://api.robinhood.com/midlands/tags/instrument/{rid}/').json()
+        tags = []
         for tag in json['tags']:
-            name = tag['name']
-            if not any(t.name == name for t in inst.tags):
-                inst.tags.append(Tag(symbol=symbol, name=name))
+            tags.append(tag['name'])
             if recommended is not None:
                 recommended.extend(url[len('https://api.robinhood.com/instruments/'):-1]
                                    for url in tag['instruments'][:10])
-        return inst
+        return values, tags
+
+    @classmethod
+    def identity_map(cls, rids):
+        # robinhood_id -> Instrument for all of `rids` in one query, the unknown ones are loaded in one pass,
+        # including delisted ones an account may still have history in
+        rids = sorted(set(rids))  # fixed order, so the popularity urls are the same from run to run
+        found = {inst.robinhood_id: inst for inst in cls.query.filter(cls.robinhood_id.in_(rids))} if rids else {}
+        missing = [s for s in rids if s not in found]
+        if missing:
+            rh, popularity = db.get_app().robinhood, {}
+            for i in range(0, len(missing), 50):
+                popularity.update(fetch_popularity(rh, missing[i:i + 50]))
+            records = cls.bulk_create_or_update({s: popularity.get(s, 0) for s in missing}, tradeable_only=False)
+            if records:
+                found.update((inst.robinhood_id, inst)
+                             for inst in cls.query.filter(cls.symbol.in_([r['symbol'] for r in records])))
+        return found
 
     def fill_fundamentals(self, json):
-        self.description = json['description'] if json['description'] else None
-        self.sector = json['sector'] if json['sector'] else None
-        self.industry = json['industry'] if json['industry'] else None
-        self.market_cap = int(float(json['market_cap'])) if json['market_cap'] else None
-        self.low_52_weeks = float(json['low_52_weeks']) if json['low_52_weeks'] else None
-        self.high_52_weeks = float(json['high_52_weeks']) if json['high_52_weeks'] else None
-        self.average_volume = int(float(json['average_volume'])) if json['average_volume'] else None
-        self.pe_ratio = float(json['pe_ratio']) if json['pe_ratio'] else None
-        self.pb_ratio = float(json['pb_ratio']) if json['pb_ratio'] else None
-        self.dividend_yield = float(json['dividend_yield']) if json['dividend_yield'] else None
-        self.ceo = json['ceo'] if json['ceo'] else None
-        self.headquarters_city = json['headquarters_city'] if json['headquarters_city'] else None
-        self.headquarters_state = json['headquarters_state'] if json['headquarters_state'] else None
-        self.num_employees = int(json['num_employees']) if json['num_employees'] else None
-        self.year_founded = int(json['year_founded']) if json['year_founded'] else None
+        for k, v in self.parse_fundamentals(json).items():
+            setattr(self, k, v)
+
+    @staticmethod
+    def parse_fundamentals(json):
+        return {
+            'description': json['description'] if json['description'] else None,
+            'sector': json['sector'] if json['sector'] else None,
+            'industry': json['industry'] if json['industry'] else None,
+            'market_cap': int(float(json['market_cap'])) if json['market_cap'] else None,
+            'low_52_weeks': float(json['low_52_weeks']) if json['low_52_weeks'] else None,
+            'high_52_weeks': float(json['high_52_weeks']) if json['high_52_weeks'] else None,
+            'average_volume': int(float(json['average_volume'])) if json['average_volume'] else None,
+            'pe_ratio': float(json['pe_ratio']) if json['pe_ratio'] else None,
+            'pb_ratio': float(json['pb_ratio']) if json['pb_ratio'] else None,
+            'dividend_yield': float(json['dividend_yield']) if json['dividend_yield'] else None,
+            'ceo': json['ceo'] if json['ceo'] else None,
+            'headquarters_city': json['headquarters_city'] if json['headquarters_city'] else None,
+            'headquarters_state': json['headquarters_state'] if json['headquarters_state'] else None,
+            'num_employees': int(json['num_employees']) if json['num_employees'] else None,
+            'year_founded': int(json['year_founded']) if json['year_founded'] else None,
+        }
 
     @classmethod
     def create_or_update_btc(cls):
@@ -148,6 +204,33 @@ class Tag(db.Model):
     name = db.Column(db.String(40), nullable=False)
 
 
+SEED_INSTRUMENTS = (
+    '5d0ab83c-ed6b-48be-a7bf-9c707498fb7d',  # EDV
+    '3cab9f3f-a8f3-498d-801c-4222a257812b',  # TLH
+    '919b4755-b122-41cc-8976-aa3ba55af8e7',  # SPTL
+)
+
+
+REFRESH_REQUESTS = 3  # instrument, fundamentals and tags
+
+
+def fetch_popularity(rh, ids, popularity_cutoff=0):
+    json = rh.get('https://api.robinhood.com/instruments/popularity/', params={'ids': ','.join(ids)}).json()
+    return {pop['instrument'][len('https://api.robinhood.com/instruments/'):-1]: pop['num_open_positions']
+            for pop in json['results'] if pop['num_open_positions'] >= popularity_cutoff}
+
+
+def fetch_prices(rh, instruments):
+    # fills the cached price of many instruments with batched quotes, BTC keeps its own endpoint
+    pending = {inst.symbol: inst for inst in instruments if inst.symbol != 'BTC' and 'price' not in inst.__dict__}
+    symbols = list(pending)
+    for i in range(0, len(symbols), 50):
+        json = rh.get('https://api.robinhood.com/quotes/', params={'symbols': ','.join(symbols[i:i + 50])}).json()
+        for quote in json['results']:
+            if quote:
+                pending[quote['symbol']].price = float(quote['last_trade_price'])
+
+
 def update_instruments(popularity_cutoff=300):
     import collections
     rh, logger = db.get_app().robinhood, db.get_app().logger
@@ -161,9 +244,7 @@ def update_instruments(popularity_cutoff=300):
     #         'https://api.robinhood.com/midlands/tags/tag/3xetf/',):
     #     queue.extend(url[len('https://api.robinhood.com/instruments/'):-1]
     #                  for url in rh.get(url).json()['instruments'][:100])
-    queue.append('5d0ab83c-ed6b-48be-a7bf-9c707498fb7d')  # EDV
-    queue.append('3cab9f3f-a8f3-498d-801c-4222a257812b')  # TLH
-    queue.append('919b4755-b122-41cc-8976-aa3ba55af8e7')  # SPTL
+    queue.extend(SEED_INSTRUMENTS)
     while queue:
         chunk = []
         while queue and len(chunk) < 50:
@@ -173,12 +254,48 @@ def update_instruments(popularity_cutoff=300):
                 chunk.append(s)
         if not chunk:
             continue
-        json = rh.get('https://api.robinhood.com/instruments/popularity/', params={'ids': ','.join(chunk)}).json()
-        chunk = {pop['instrument'][len('https://api.robinhood.com/instruments/'):-1]: pop['num_open_positions']
-                 for pop in json['results'] if pop['num_open_positions'] >= popularity_cutoff}
+        chunk = fetch_popularity(rh, chunk, popularity_cutoff)
         if not chunk:
             continue
-        for s, p in chunk.items():
-            logger.info('%d. %s', count + 1, Instrument.create_or_update(s, p, queue))
+        for values in Instrument.bulk_create_or_update(chunk, queue):
+            logger.info('%d. %s', count + 1, Instrument.describe(values))
+            count += 1
+        db.session.commit()
+
+
+def refresh_instruments(budget=1000, min_interval_hours=20, max_interval_days=14):
+    rh, logger = db.get_app().robinhood, db.get_app().logger
+    now, requests = datetime.utcnow(), 0
+    min_interval, max_interval = timedelta(hours=min_interval_hours), timedelta(days=max_interval_days)
+    instruments = {inst.robinhood_id: inst for inst in Instrument.query.filter(Instrument.symbol != 'BTC')}
+
+    # popularity is cheap (50 ids per request) and drives the priority, so refresh it first, for as many instruments
+    # as the budget allows: stalest first, a refreshed one moves to the back of the next runs
+    ids = [inst.robinhood_id for inst in sorted(instruments.values(), key=lambda inst: inst.last_update)]
+    for i in range(0, min(len(ids), budget * 50), 50):
+        for s, p in fetch_popularity(rh, ids[i:i + 50]).items():
+            instruments[s].popularity = p
+        requests += 1
+    db.session.commit()
+
+    # popular and fast-moving instruments are due sooner, between min_interval and max_interval
+    def overdue(inst):
+        base = inst.refresh_popularity or inst.popularity
+        change = abs(inst.popularity - base) / max(base, 1)
+        interval = max(max_interval / (math.log10(inst.popularity + 10) * (1 + 10 * change)), min_interval)
+        return (now - inst.last_update) / interval
+
+    due = sorted((inst for inst in instruments.values() if overdue(inst) >= 1), key=overdue, reverse=True)
+    count, refresh = 0, due[:max(budget - requests, 0) // REFRESH_REQUESTS]
+    for i in range(0, len(refresh), 50):
+        chunk = {inst.robinhood_id: inst for inst in refresh[i:i + 50]}
+        for values in Instrument.bulk_create_or_update({s: inst.popularity for s, inst in chunk.items()}):
             count += 1
+            logger.info('%d. %s', count, Instrument.describe(values))
+            del chunk[values['robinhood_id']]
+        for inst in chunk.values():  # no longer tradeable, don't let it hog the budget of every run
+            inst.last_update = now
         db.session.commit()
+    requests += len(refresh) * REFRESH_REQUESTS
+    logger.info('Refreshed %d of %d due instruments (%d total) with %d requests',
+                count, len(due), len(instruments), requests)
@@ -1,17 +1,25 @@
+import base64
+import json
 import os
-from datetime import datetime, date
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, date, timedelta
 
 import requests
 
 from . import db
+from .bulk import bulk_insert_missing
 
-M1_USERNAME = os.environ['M1_USERNAME']
-M1_PASSWORD = os.environ['M1_PASSWORD']
-M1_ACCT_ID = os.environ['M1_ACCT_ID']
+PERFORMANCE_FIELDS = 'startValue { date, value }, endValue { date, value }, ' \
+                     'moneyWeightedRateOfReturn, totalGain, capitalGain, earnedDividends, netCashFlow'
+TOKEN_TTL = 600  # for tokens that don't carry their own expiry
+AUTH_ERRORS = ('UNAUTHENTICATED', 'UNAUTHORIZED')  # graphql error codes of a missing or expired token
 
 
 class M1Portfolio(db.Model):
     id = db.Column(db.Integer, primary_key=True)
+    account = db.Column(db.String(40))
     date = db.Column(db.Date)
     value = db.Column(db.Float)
     day_net_cash_flow = db.Column(db.Float)
@@ -29,65 +37,172 @@ class M1Portfolio(db.Model):
     all_start_time = db.Column(db.DateTime)
     all_start_value = db.Column(db.Float)
     last_update = db.Column(db.DateTime)
+    __table_args__ = (db.Index('ix_m1_portfolio_account_day_start_time', 'account', 'day_start_time', unique=True),)
 
     def __str__(self):
-        return f'[{self.date}] {self.value} | ' \
+        return f'[{self.date}] {self.account} {self.value} | ' \
             f'{self.day_total_gain}/{self.day_return_rate}% | {self.all_total_gain}/{self.all_return_rate}%'
 
     @classmethod
-    def create_or_update(cls):
-        token = graphql(f'mutation {{ authenticate(input: {{username: "{M1_USERNAME}", password: "{M1_PASSWORD}"}})'
-                        f' {{ accessToken }}}}')['data']['authenticate']['accessToken']
-        day = graphql(f'{{ node(id: "{M1_ACCT_ID}") {{ ... on PortfolioSlice {{ performance(period: ONE_DAY) '
-                      f'{{ startValue {{ date, value }}, endValue {{ date, value }}, '
-                      f'moneyWeightedRateOfReturn, totalGain, capitalGain, earnedDividends, netCashFlow '
-                      f'}}}}}}}}', {'Authorization': f'Bearer {token}'})['data']['node']['performance']
-        start_time = parse_datetime(day['startValue']['date'])
-        inst = cls.query.filter_by(day_start_time=start_time).first()
+    def create_or_update(cls, account, acct_id, m1=None, performance=None):
+        performance = performance or fetch_m1_account(acct_id, m1)
+        values = cls.parse(account, date.today(), performance['day'], performance['all'])
+        inst = cls.query.filter_by(account=account, day_start_time=values['day_start_time']).first()
         if not inst:
-            inst = cls(date=date.today(), day_start_time=start_time)
+            inst = cls()
             db.session.add(inst)
-        inst.value = day['endValue']['value']
-
-        inst.day_net_cash_flow = day['netCashFlow']
-        inst.day_capital_gain = day['capitalGain']
-        inst.day_dividend_gain = day['earnedDividends']
-        inst.day_total_gain = day['totalGain']
-        inst.day_return_rate = day['moneyWeightedRateOfReturn']
-        # inst.day_start_time = parse_datetime(day['startValue']['date'])
-        inst.day_start_value = day['startValue']['value']
-
-        all = graphql(f'{{ node(id: "{M1_ACCT_ID}") {{ ... on PortfolioSlice {{ performance(period: MAX) '
-                      f'{{ startValue {{ date, value }}, '
-                      f'moneyWeightedRateOfReturn, totalGain, capitalGain, earnedDividends, netCashFlow '
-                      f'}}}}}}}}', {'Authorization': f'Bearer {token}'})['data']['node']['performance']
-        inst.all_net_cash_flow = all['netCashFlow']
-        inst.all_capital_gain = all['capitalGain']
-        inst.all_dividend_gain = all['earnedDividends']
-        inst.all_total_gain = all['totalGain']
-        inst.all_return_rate = all['moneyWeightedRateOfReturn']
-        inst.all_start_time = parse_datetime(all['startValue']['date'])
-        inst.all_start_value = all['startValue']['value']
-
-        inst.last_update = datetime.utcnow()
+        for k, v in values.items():
+            setattr(inst, k, v)
         return inst
 
+    @staticmethod
+    def parse(account, day_date, day, all):
+        return {'account': account, 'date': day_date, 'value': day['endValue']['value'],
+                'day_net_cash_flow': day['netCashFlow'], 'day_capital_gain': day['capitalGain'],
+                'day_dividend_gain': day['earnedDividends'], 'day_total_gain': day['totalGain'],
+                'day_return_rate': day['moneyWeightedRateOfReturn'],
+                'day_start_time': parse_datetime(day['startValue']['date']),
+                'day_start_value': day['startValue']['value'],
+                'all_net_cash_flow': all['netCashFlow'], 'all_capital_gain': all['capitalGain'],
+                'all_dividend_gain': all['earnedDividends'], 'all_total_gain': all['totalGain'],
+                'all_return_rate': all['moneyWeightedRateOfReturn'],
+                'all_start_time': parse_datetime(all['startValue']['date']),
+                'all_start_value': all['startValue']['value'],
+                'last_update': datetime.utcnow()}
+
     @classmethod
-    def net_value_series(cls, limit=10):
-        # source = cls.query.filter(cls.date >= date(2019, 7, 18)).order_by(cls.date.desc())[:limit]
-        source = cls.query.order_by(cls.date.desc())[:limit]
-        s = source[0]
-        series = [(s.date, s.value, s.day_return_rate, s.all_return_rate,
-                   round(s.value * (s.day_return_rate / (100 + s.day_return_rate)), 2))]
-        for i in range(1, len(source)):
-            s, v = source[i], round(series[-1][1] / (1 + source[i - 1].day_return_rate / 100), 2)
-            series.append((s.date, v, s.day_return_rate, s.all_return_rate,
-                           round(v * (s.day_return_rate / (100 + s.day_return_rate)), 2)))
-        return list(reversed(series))
+    def net_value_series(cls, account, limit=10):
+        # Values are walked back from the latest one through the daily return rates, so a longer window only adds
+        # older rows: the whole history is derived once per change to the account's rows and then sliced.
+        import pandas as pd
+        version = db.session.query(db.func.count(cls.id), db.func.max(cls.last_update)).filter_by(account=account).one()
+        cached = net_values.get(account)
+        if not cached or cached[0] != tuple(version):
+            query = db.select([cls.date, cls.value, cls.day_return_rate, cls.all_return_rate]) \
+                .where(cls.account == account).order_by(cls.date)
+            frame = pd.read_sql(query, db.session.connection(), index_col='date', parse_dates=['date'])
+            growth = 1 + frame['day_return_rate'] / 100
+            later_growth = growth[::-1].cumprod()[::-1] / growth  # product of the growth of every later day
+            frame['value'] = (frame['value'].iloc[-1] / later_growth).round(2) if len(frame) else frame['value']
+            frame['gain'] = (frame['value'] * (frame['day_return_rate'] / (100 + frame['day_return_rate']))).round(2)
+            cached = net_values[account] = tuple(version), frame
+        return cached[1].tail(limit).copy()
+
+
+def m1_accounts():
+    # M1_ACCOUNTS is a comma separated list of name:id, a lone M1_ACCT_ID is the Individual account
+    if 'M1_ACCOUNTS' not in os.environ:
+        return [('Individual', os.environ['M1_ACCT_ID'])]
+    return [tuple(a.strip() for a in entry.split(':', 1)) for entry in os.environ['M1_ACCOUNTS'].split(',')]
+
+
+class M1Client:
+    # A pooled session plus the access token, which is reused until it expires or the api rejects it. The token is
+    # kept under cache/m1 too, so other clients and later processes skip the login. Not shared between threads: the
+    # account sync gives every account its own client.
+    def __init__(self, http=None, url=None, persist=True):
+        self.http = http or requests.Session()
+        self.url = url or os.environ.get('M1_GRAPHQL_URL', 'https://lens.m1finance.com/graphql')
+        self.persist = persist
+        self.token, self.expires_at = None, 0
+
+    def authenticate(self):
+        username, password = os.environ['M1_USERNAME'], os.environ['M1_PASSWORD']
+        self.token = self.graphql(f'mutation {{ authenticate(input: {{username: "{username}", '
+                                  f'password: "{password}"}}) {{ accessToken }}}}',
+                                  auth=False)['data']['authenticate']['accessToken']
+        self.expires_at = token_expiry(self.token) - 60
+        if self.persist:
+            self.save_token()
+
+    def graphql(self, query, auth=True):
+        if auth and (not self.token or time.time() >= self.expires_at) and not self.load_token():
+            self.authenticate()
+        response = self.post(query, auth)
+        if auth and (response.status_code == 401 or auth_error(response)):
+            self.authenticate()
+            response = self.post(query, auth)
+        payload = response.json()
+        if payload.get('errors') and payload.get('data') is None:
+            # the whole query was rejected, e.g. an argument the schema doesn't have; retrying won't help
+            raise RuntimeError(f"M1 rejected the query: {'; '.join(e.get('message', '') for e in payload['errors'])}")
+        return payload
+
+    def post(self, query, auth):
+        headers = {'Authorization': f'Bearer {self.token}'} if auth else None
+        return self.http.post(self.url, json={'query': query}, headers=headers)
+
+    def token_path(self):
+        from hashlib import sha1
+        from .cache import cache_dir
+        key = sha1(f"{self.url} {os.environ.get('M1_USERNAME')}".encode()).hexdigest()
+        return os.path.join(cache_dir('m1'), f'token-{key}.json')
+
+    def load_token(self):
+        if not self.persist:
+            return False
+        try:
+            with open(self.token_path()) as f:
+                stored = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if time.time() >= stored['expires_at']:
+            return False
+        self.token, self.expires_at = stored['token'], stored['expires_at']
+        return True
+
+    def save_token(self):
+        # written to a private temp file and renamed over the old one, concurrent clients never read half a file
+        import tempfile
+        path = self.token_path()
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'token': self.token, 'expires_at': self.expires_at}, f)
+        os.replace(tmp, path)
+
+    def performance(self, acct_id, **periods):
+        # one round trip for any number of periods, each under its alias, e.g. performance(id, day='period: ONE_DAY')
+        fields = ' '.join(f'{alias}: performance({arguments}) {{ {PERFORMANCE_FIELDS} }}'
+                          for alias, arguments in periods.items())
+        query = f'{{ node(id: "{acct_id}") {{ ... on PortfolioSlice {{ {fields} }}}}}}'
+        return self.graphql(query)['data']['node']
+
+    def current_value(self, acct_id):
+        return self.performance(acct_id, day='period: ONE_DAY')['day']['endValue']['value']
 
+    def history(self, acct_id, days):
+        # The daily performance of each of `days`, and the performance since inception as of that day. Assumes the
+        # performance field takes an endDate (and a startDate instead of a period) for past ranges, graphql raises
+        # if it doesn't; days the api has no data for are left out.
+        periods = {}
+        for d in days:
+            periods[f'day{d:%Y%m%d}'] = f'startDate: "{d - timedelta(days=1)}", endDate: "{d}"'
+            periods[f'all{d:%Y%m%d}'] = f'period: MAX, endDate: "{d}"'
+        performance = self.performance(acct_id, **periods)
+        return {d: (performance[f'day{d:%Y%m%d}'], performance[f'all{d:%Y%m%d}']) for d in days
+                if performance.get(f'day{d:%Y%m%d}') and performance.get(f'all{d:%Y%m%d}')}
 
-def graphql(query, headers=None):
-    return requests.post('https://lens.m1finance.com/graphql', json={'query': query}, headers=headers).json()
+
+def token_expiry(token):
+    try:
+        payload = token.split('.')[1]
+        return json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))['exp']
+    except (IndexError, KeyError, TypeError, ValueError):
+        return time.time() + TOKEN_TTL
+
+
+def auth_error(response):
+    # an expired token may also come back as http 200 with the error in the graphql payload
+    try:
+        payload = response.json()
+    except ValueError:
+        return False
+    errors = payload.get('errors') or [] if isinstance(payload, dict) else []
+    return any((e.get('extensions') or {}).get('code') in AUTH_ERRORS for e in errors if isinstance(e, dict))
+
+
+client = M1Client()
+net_values = {}  # account -> ((row count, latest update), net value frame)
 
 
 def parse_datetime(dt):
@@ -95,9 +210,55 @@ def parse_datetime(dt):
 
 
 def update_m1_account():
+    for account, acct_id in m1_accounts():
+        sync_m1_account(account, acct_id)
+
+
+def fetch_m1_account(acct_id, m1=None):
+    return (m1 or client).performance(acct_id, day='period: ONE_DAY', all='period: MAX')
+
+
+def sync_m1_account(account, acct_id, m1=None, performance=None):
     logger = db.get_app().logger
-    logger.info('%s', M1Portfolio.create_or_update())
-    logger.info('Latest net values:')
-    for d, v, r1, r2, y in M1Portfolio.net_value_series(20):
-        logger.info('%s: %s (%+.2f) \t| %+.2f%% / %.2f%%', d, v, y, r1, r2)
+    logger.info('%s', M1Portfolio.create_or_update(account, acct_id, m1, performance))
+    logger.info('Latest net values of %s:', account)
+    for d, v, r1, r2, y in M1Portfolio.net_value_series(account, 20).itertuples():
+        logger.info('%s: %s (%+.2f) \t| %+.2f%% / %.2f%%', d.date(), v, y, r1, r2)
     db.session.commit()
+
+
+def backfill_m1_account(start=None, end=None, workers=8, batch_size=20, retries=3):
+    # Fills in the weekdays between `start` (by default the first synced day) and `end` (yesterday) that have no row,
+    # `batch_size` days per request and `workers` requests at a time. Rows already present are never touched.
+    logger, local = db.get_app().logger, threading.local()
+    end = end or date.today() - timedelta(days=1)
+    main = M1Client()
+
+    def fetch(acct_id, days):
+        if not hasattr(local, 'client'):  # a client per thread, all starting from the token fetched below
+            local.client = M1Client()
+            local.client.token, local.client.expires_at = main.token, main.expires_at
+        for attempt in range(retries + 1):
+            try:
+                return local.client.history(acct_id, days)
+            except (requests.RequestException, KeyError, TypeError, ValueError) as e:
+                if attempt == retries:
+                    logger.warning('Gave up on %s to %s: %r', days[0], days[-1], e)
+                    return {}
+                time.sleep(2 ** attempt)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for account, acct_id in m1_accounts():
+            known = {d for d, in db.session.query(M1Portfolio.date).filter_by(account=account)}
+            first = start or min(known, default=end)
+            days = [first + timedelta(days=i) for i in range((end - first).days + 1)]
+            days = [d for d in days if d.weekday() < 5 and d not in known]
+            chunks = [days[i:i + batch_size] for i in range(0, len(days), batch_size)]
+            if chunks and not main.token and not main.load_token():
+                main.authenticate()  # once, before the workers start, and not at all when nothing is missing
+            records = [M1Portfolio.parse(account, d, day, all)
+                       for history in pool.map(lambda chunk: fetch(acct_id, chunk), chunks)
+                       for d, (day, all) in sorted(history.items())]
+            count = bulk_insert_missing(M1Portfolio, records, ('account', 'day_start_time'))
+            db.session.commit()
+            logger.info('%s: %d missing days, %d fetched, %d inserted', account, len(days), len(records), count)
@@ -0,0 +1,59 @@
+import collections
+
+from sqlalchemy.orm import selectinload
+
+from . import db
+from .instrument import fetch_prices
+
+
+class Trade(collections.namedtuple('Trade', 'account symbol quantity price amount target current')):
+    # quantity and amount are signed, positive to buy; target and current are market values
+
+    def __str__(self):
+        return f'{self.symbol} {self.quantity:+.1f} ({self.amount:.2f}/{self.price:.2f})'
+
+
+def rebalance(targets, holdings, prices, buying_power, available=None, band=.02, whole_shares=False, min_trade=0.,
+              account=None):
+    # targets are {symbol: percent of buying power}, holdings {symbol: quantity} and prices {symbol: price}.
+    # Held symbols without a target are sold off, targets within `band` of buying power are left alone, and with
+    # `available` (cash plus margin) the buys are scaled down to what it and the sells can fund.
+    import numpy as np
+    symbols = list(dict.fromkeys([*targets, *holdings]))
+    if not symbols:
+        return []
+    price = np.array([prices[s] for s in symbols], dtype=float)
+    held = np.array([holdings.get(s, 0) for s in symbols], dtype=float)
+    managed = np.array([s in targets for s in symbols])
+    target = np.array([targets.get(s, 0) for s in symbols], dtype=float) * buying_power / 100
+    current = held * price
+    amount = target - current
+    amount[managed & (np.abs(amount) <= buying_power * band)] = 0
+    quantity = np.where(managed, amount / price, -held)
+    if whole_shares:
+        quantity[managed] = np.trunc(quantity[managed])  # toward zero, so a trade never overshoots its target
+    amount = quantity * price
+    buys, sells = amount[amount > 0].sum(), -amount[amount < 0].sum()
+    if available is not None and buys > available + sells:
+        quantity[amount > 0] *= max(available + sells, 0) / buys
+        if whole_shares:
+            quantity[amount > 0] = np.floor(quantity[amount > 0])
+        amount = quantity * price
+    keep = (quantity != 0) & (np.abs(amount) >= min_trade)
+    return [Trade(account, symbols[i], float(quantity[i]), float(price[i]), round(float(amount[i]), 2),
+                  round(float(target[i]), 2), round(float(current[i]), 2))
+            for i in np.argsort(-np.abs(amount), kind='stable') if keep[i]]
+
+
+def rebalance_portfolio(portfolio, settings=None, account='robinhood', **kwargs):
+    from .account import PositionSetting, margin_limit
+    if settings is None:
+        settings = PositionSetting.query.options(selectinload(PositionSetting.instrument)).all()
+    positions = {pos.symbol: pos for pos in portfolio.positions if pos.symbol != 'BTC' and pos.quantity > 0}
+    fetch_prices(db.get_app().robinhood, [s.instrument for s in settings if s.symbol not in positions])
+    prices = {**{s.symbol: s.instrument.price for s in settings if s.symbol not in positions},
+              **{pos.symbol: pos.current_price for pos in positions.values()}}
+    # buys are not capped by cash unless asked to, e.g. available=portfolio.cash_value + margin_limit(), like the
+    # recommendations always were
+    return rebalance({s.symbol: s.proportion for s in settings}, {s: pos.quantity for s, pos in positions.items()},
+                     prices, portfolio.equity + margin_limit(), account=account, **kwargs)
@@ -0,0 +1,89 @@
+import hashlib
+import json
+import os
+import time
+
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.exceptions import ConnectionError
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
+
+# Fixtures are one json file per request, named by a hash of method, url and body. Request headers are never
+# written and tokens in json response bodies are replaced, but the bodies hold account data: keep fixture dirs
+# out of git.
+DROPPED_HEADERS = ('content-encoding', 'content-length', 'transfer-encoding', 'set-cookie')
+SECRET_FIELDS = ('accessToken', 'refreshToken', 'access_token', 'refresh_token', 'id_token')
+REDACTED = 'redacted'
+
+
+def fixture_name(request):
+    body = request.body or b''
+    if isinstance(body, str):
+        body = body.encode()
+    return hashlib.sha1(f'{request.method} {request.url}\n'.encode() + body).hexdigest() + '.json'
+
+
+def scrub(value):
+    if isinstance(value, dict):
+        return {k: REDACTED if k in SECRET_FIELDS and v else scrub(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [scrub(v) for v in value]
+    return value
+
+
+def scrub_body(body):
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return body
+    scrubbed = scrub(data)
+    return json.dumps(scrubbed) if scrubbed != data else body
+
+
+class RecordingAdapter(HTTPAdapter):
+    def __init__(self, path, **kwargs):
+        super().__init__(**kwargs)
+        os.makedirs(path, exist_ok=True)
+        self.path, self.count = path, 0
+
+    def send(self, request, **kwargs):
+        response = super().send(request, **kwargs)
+        self.count += 1
+        with open(os.path.join(self.path, fixture_name(request)), 'w') as f:
+            json.dump({'method': request.method, 'url': request.url,
+                       'status': response.status_code, 'reason': response.reason,
+                       'headers': {k: v for k, v in response.headers.items() if k.lower() not in DROPPED_HEADERS},
+                       'body': scrub_body(response.content.decode(response.encoding or 'utf-8'))}, f)
+        return response
+
+
+class ReplayAdapter(BaseAdapter):
+    def __init__(self, path, latency=0):
+        super().__init__()
+        self.path, self.latency, self.count = path, latency, 0
+
+    def send(self, request, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        self.count += 1
+        try:
+            with open(os.path.join(self.path, fixture_name(request))) as f:
+                fixture = json.load(f)
+        except FileNotFoundError:
+            raise ConnectionError(f'No fixture for {request.method} {request.url}', request=request)
+        response = Response()
+        response.status_code, response.reason = fixture['status'], fixture['reason']
+        response.headers = CaseInsensitiveDict(fixture['headers'])
+        response._content, response.encoding = fixture['body'].encode('utf-8'), 'utf-8'
+        response.url, response.request, response.connection = request.url, request, self
+        return response
+
+    def close(self):
+        pass
+
+
+def use_fixtures(session, path, record=False, latency=0):
+    adapter = RecordingAdapter(path) if record else ReplayAdapter(path, latency)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return adapter
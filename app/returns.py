@@ -0,0 +1,87 @@
+import os
+import pickle
+import re
+from datetime import date, datetime, timedelta
+
+from . import db
+from .cache import cache_dir
+
+# Daily returns are cached per source under cache/returns. Account sources pick up the rows updated since the
+# newest last_update they have seen, benchmark quotes are fetched again once VENDOR_TTL has passed, from OVERLAP
+# before the last cached day so late corrections of the vendor replace the cached days.
+VENDOR_TTL = timedelta(hours=6)
+OVERLAP = timedelta(days=7)
+
+
+def net_values(accounts=None, symbols=('SPY',), start=None, limit=None, base=100):
+    # one column per account and benchmark symbol, on the days every one of them has a return, starting at `base`
+    import pandas as pd
+    from .sync import accounts as registry
+    kinds = {a.name: a.kind for a in registry()}
+    returns = {name: account_returns(name, kinds[name]) for name in (kinds if accounts is None else accounts)}
+    if start is None:
+        start = min((r.index[0] for r in returns.values() if len(r)), default=date.today() - timedelta(days=365))
+    start = pd.Timestamp(start)
+    returns.update({symbol: quote_returns(symbol, start) for symbol in symbols})
+    frame = pd.DataFrame({name: r[start:] for name, r in returns.items()}).dropna()
+    if limit:
+        frame = frame.tail(limit)
+    return (1 + frame).cumprod() / (1 + frame.iloc[0]) * base if len(frame) else frame
+
+
+def account_returns(name, kind):
+    if kind == 'robinhood':
+        from .account import Portfolio
+        return table_returns(f'account-{name}', Portfolio, Portfolio.today_return_pct)
+    from .m1 import M1Portfolio
+    return table_returns(f'account-{name}', M1Portfolio, M1Portfolio.day_return_rate, M1Portfolio.account == name)
+
+
+def table_returns(name, model, column, *criterion):
+    import pandas as pd
+    cached = load(name)
+    query = db.select([model.date, column.label('return_pct'), model.last_update]) \
+        .where(db.and_(*criterion)).order_by(model.date, model.last_update)
+    if cached:
+        query = query.where(model.last_update > cached['watermark'])
+    rows = pd.read_sql(query, db.session.connection(), parse_dates=['date', 'last_update'])
+    if not len(rows):
+        return cached['returns'] if cached else pd.Series(dtype=float, name=name)
+    fresh = rows.drop_duplicates('date', keep='last').set_index('date')['return_pct'].dropna() / 100
+    returns = fresh.combine_first(cached['returns']) if cached else fresh
+    save(name, returns.rename(name), watermark=rows['last_update'].max().to_pydatetime())
+    return returns.rename(name)
+
+
+def quote_returns(symbol, start):
+    from .analysis import data_reader
+    name, cached = f'quote-{symbol}', load(f'quote-{symbol}')
+    if cached and cached['since'] <= start:
+        if datetime.utcnow() - cached['watermark'] < VENDOR_TTL:
+            return cached['returns']
+        start = cached['returns'].index[-1] - OVERLAP if len(cached['returns']) else cached['since']
+    prices = data_reader([symbol], start)[symbol]
+    fresh = prices.pct_change().dropna()
+    returns = fresh.combine_first(cached['returns']) if cached else fresh
+    since = min(start, cached['since']) if cached else start
+    save(name, returns.rename(symbol), watermark=datetime.utcnow(), since=since)
+    return returns.rename(symbol)
+
+
+def path(name):
+    return os.path.join(cache_dir('returns'), re.sub(r'[^\w.-]', '_', name) + '.pkl')
+
+
+def load(name):
+    try:
+        with open(path(name), 'rb') as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def save(name, returns, **meta):
+    tmp = path(name) + '.tmp'
+    with open(tmp, 'wb') as f:
+        pickle.dump({'returns': returns, **meta}, f)
+    os.replace(tmp, path(name))
@@ -0,0 +1,111 @@
+import time
+from array import array
+from datetime import datetime
+
+from . import db
+
+
+class EquitySnapshot(db.Model):
+    # intraday samples of one account for one (utc) day, packed as native doubles: epoch seconds and equity
+    id = db.Column(db.Integer, primary_key=True)
+    account = db.Column(db.String(40), nullable=False)
+    date = db.Column(db.Date, nullable=False)
+    count = db.Column(db.Integer, nullable=False)
+    timestamps = db.Column(db.LargeBinary, nullable=False)
+    values = db.Column(db.LargeBinary, nullable=False)
+    last_update = db.Column(db.DateTime, nullable=False)
+    __table_args__ = (db.UniqueConstraint('account', 'date'),)
+
+    def __str__(self):
+        return f'[{self.date}] {self.account} {self.count} samples'
+
+    @classmethod
+    def append(cls, samples):
+        # samples are {(account, date): (timestamps, values)}, each bucket becomes one row read and written
+        existing = {(inst.account, inst.date): inst for inst in cls.query.filter(
+            cls.account.in_({a for a, _ in samples}), cls.date.in_({d for _, d in samples}))}
+        for (account, day), (timestamps, values) in samples.items():
+            inst = existing.get((account, day))
+            if not inst:
+                inst = cls(account=account, date=day, count=0, timestamps=b'', values=b'')
+                db.session.add(inst)
+            inst.timestamps += array('d', timestamps).tobytes()
+            inst.values += array('d', values).tobytes()
+            inst.count += len(timestamps)
+            inst.last_update = datetime.utcnow()
+
+    @classmethod
+    def series(cls, account, start=None, end=None):
+        import numpy as np
+        import pandas as pd
+        # start and end are dates or datetimes, a date end takes in that whole day
+        query = cls.query.filter_by(account=account).order_by(cls.date)
+        if start:
+            query = query.filter(cls.date >= (start.date() if isinstance(start, datetime) else start))
+        if end:
+            query = query.filter(cls.date <= (end.date() if isinstance(end, datetime) else end))
+        rows = query.with_entities(cls.timestamps, cls.values).all()
+        timestamps = np.concatenate([np.frombuffer(t, dtype='d') for t, _ in rows]) if rows else np.empty(0)
+        values = np.concatenate([np.frombuffer(v, dtype='d') for _, v in rows]) if rows else np.empty(0)
+        series = pd.Series(values, index=pd.to_datetime(timestamps, unit='s'), name=account).sort_index()
+        if end and not isinstance(end, datetime):
+            end = pd.Timestamp(end) + pd.Timedelta(days=1) - pd.Timedelta(1)
+        return series[pd.Timestamp(start) if start else None:pd.Timestamp(end) if end else None]
+
+
+class SnapshotBuffer:
+    def __init__(self):
+        self.samples = {}
+
+    def __len__(self):
+        return sum(len(t) for t, _ in self.samples.values())
+
+    def add(self, account, timestamp, value):
+        timestamps, values = self.samples.setdefault((account, datetime.utcfromtimestamp(timestamp).date()), ([], []))
+        timestamps.append(timestamp)
+        values.append(value)
+
+    def flush(self):
+        count, samples, self.samples = len(self), self.samples, {}
+        if samples:
+            EquitySnapshot.append(samples)
+            db.session.commit()
+        return count
+
+
+def robinhood_equity():
+    rh = db.get_app().robinhood
+    stocks = rh.get('https://api.robinhood.com/portfolios/').json()['results'][0]
+    coins = rh.get('https://nummus.robinhood.com/portfolios/').json()['results'][0]
+    return float(stocks['extended_hours_equity'] or stocks['equity']) \
+        + float(coins['extended_hours_market_value'] or coins['market_value'])
+
+
+def samplers():
+    from .m1 import M1Client
+    from .sync import accounts
+    m1 = M1Client()
+    return {account.name: robinhood_equity if account.kind == 'robinhood' else
+            (lambda acct_id=account.id: m1.current_value(acct_id)) for account in accounts()}
+
+
+def poll_equity(interval=60, flush_interval=900, duration=None):
+    # Samples every account each `interval` seconds and writes the buffered samples every `flush_interval`
+    # seconds (and on exit), so a day of minute samples costs one row per account instead of hundreds.
+    logger, sources, buffer = db.get_app().logger, samplers(), SnapshotBuffer()
+    started = time.time()
+    next_flush = started + flush_interval
+    try:
+        while duration is None or time.time() - started < duration:
+            now = time.time()
+            for account, sample in sources.items():
+                try:
+                    buffer.add(account, now, sample())
+                except Exception as e:
+                    logger.warning('Failed to sample %s: %r', account, e)
+            if now >= next_flush:
+                logger.info('Flushed %d samples', buffer.flush())
+                next_flush = now + flush_interval
+            time.sleep(max(0., interval - (time.time() - now)))
+    finally:
+        logger.info('Flushed %d samples', buffer.flush())
@@ -0,0 +1,67 @@
+import collections
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from . import db
+
+Account = collections.namedtuple('Account', 'name kind id')
+
+
+def accounts():
+    from .m1 import m1_accounts
+    return [Account('Robinhood', 'robinhood', None),
+            *(Account(name, 'm1', acct_id) for name, acct_id in m1_accounts())]
+
+
+def sync_accounts(workers=None):
+    # Every account is fetched on its own thread with its own app context and its own http session where the client
+    # allows it, but the fetched records are written and committed here one account at a time, since sqlite takes
+    # a single writer. A failing account is rolled back and reported, the others carry on.
+    app, logger = db.get_app(), db.get_app().logger
+    registry = accounts()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers or len(registry)) as pool:
+        fetched = list(pool.map(lambda account: fetch_account(app, account), registry))
+    results = [apply_account(app, account, *result) for account, result in zip(registry, fetched)]
+    wall = time.perf_counter() - started
+    logger.info('Synced %d accounts in %.2fs (%.2fs serially):', len(registry), wall, sum(e for _, e, _ in results))
+    for account, (status, elapsed, error) in zip(registry, results):
+        logger.info('%-12s %-9s %-6s %.2fs %s', account.name, account.kind, status, elapsed, error or '')
+    return results
+
+
+def fetch_account(app, account):
+    from .account import fetch_rh_account
+    from .m1 import M1Client, fetch_m1_account
+    started = time.perf_counter()
+    with app.app_context():
+        try:
+            if account.kind == 'robinhood':
+                records = fetch_rh_account()
+            else:
+                m1 = M1Client()
+                with m1.http:
+                    records = fetch_m1_account(account.id, m1)
+        except Exception as e:
+            db.session.rollback()
+            app.logger.exception('Failed to fetch %s', account.name)
+            return None, time.perf_counter() - started, repr(e)
+    return records, time.perf_counter() - started, None
+
+
+def apply_account(app, account, records, elapsed, error):
+    from .account import apply_rh_account
+    from .m1 import sync_m1_account
+    if error:
+        return 'failed', elapsed, error
+    started = time.perf_counter()
+    try:
+        if account.kind == 'robinhood':
+            apply_rh_account(records)
+        else:
+            sync_m1_account(account.name, account.id, performance=records)
+    except Exception as e:
+        db.session.rollback()
+        app.logger.exception('Failed to sync %s', account.name)
+        return 'failed', elapsed + time.perf_counter() - started, repr(e)
+    return 'ok', elapsed + time.perf_counter() - started, None
@@ -0,0 +1,16 @@
+import pytest
+
+from app import create_app, db
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    # a throwaway sqlite database with every table, inside an app context
+    from app import account, instrument, m1, snapshot  # noqa: F401, registers the models
+    monkeypatch.setenv('CACHE_DIR', str(tmp_path / 'cache'))
+    app = create_app()
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + str(tmp_path / 'portfolio')
+    with app.app_context():
+        db.create_all()
+        yield db
+        db.session.remove()
@@ -0,0 +1,78 @@
+from datetime import date, datetime
+
+import pytest
+
+from app import account
+from app.account import Dividend, Order, Portfolio, Position
+from app.instrument import Instrument
+
+# day -> (orders as (side, quantity, price), dividend, quantity held, closing price); SPY is sold out on the 4th
+# and bought back on the 5th, which starts a new position chain
+DAYS = {date(2020, 1, 1): ([('buy', 10, 100)], 0, 10, 101),
+        date(2020, 1, 2): ([('buy', 5, 102)], 0, 15, 99),
+        date(2020, 1, 3): ([], 3, 15, 104),
+        date(2020, 1, 4): ([('sell', 15, 105)], 0, 0, 105),
+        date(2020, 1, 5): ([('buy', 4, 106)], 0, 4, 107)}
+
+
+@pytest.fixture
+def history(database, monkeypatch):
+    # the rows the daily sync leaves behind, built day by day through create_or_update
+    database.get_app().robinhood = None
+    spy = Instrument(symbol='SPY', robinhood_id='spy', name='SPY', list_date=datetime(2000, 1, 1), popularity=1,
+                     last_update=datetime(2020, 1, 1))
+    database.session.add(spy)
+    previous, cost = None, 0
+    for day, (orders, dividend, quantity, price) in DAYS.items():
+        monkeypatch.setattr(account, 'date', type('date', (date,), {'today': classmethod(lambda cls: day)}))
+        for i, (side, count, at) in enumerate(orders):
+            Order.create_or_update(f'{day}-{i}', spy, f'{day}T15:00:00Z', at, count, 0, side)
+        if dividend:
+            Dividend.create_or_update(f'{day}-d', spy, dividend, f'{day}T15:00:00Z', .2, quantity)
+        cost += 1000
+        equity = round(quantity * price, 2)
+        portfolio = Portfolio.create_or_update(
+            cost, {'results': [{'market_value': equity, 'equity': equity + 500, 'extended_hours_equity': None,
+                                'extended_hours_market_value': None}]},
+            {'results': [{'market_value': 0, 'extended_hours_market_value': None}]})
+        spy.price = price
+        previous = Position.create_or_update(spy, previous, portfolio, quantity)
+        database.session.commit()
+    return database
+
+
+def test_average_cost_is_the_mean_cost_of_held_days(history):
+    rows = Position.query.order_by(Position.date).all() + Portfolio.query.order_by(Portfolio.date).all()
+    for row in rows:
+        if row.cost_count:
+            assert row.average_cost == pytest.approx(sum(row.cost_timeline()) / len(list(row.cost_timeline())),
+                                                     abs=.01)
+    assert [p.previous is None for p in Position.query.order_by(Position.date)] == [True, False, False, False, True]
+
+
+def results(model, columns):
+    return {row.id: tuple(getattr(row, c) for c in columns) for row in model.query.order_by(model.id)}
+
+
+def test_recompute_returns_matches_create_or_update(history):
+    position_columns = ('cost', 'avg_buy_price', 'cost_sum', 'cost_count', 'today_return_pct', 'total_return_pct')
+    portfolio_columns = ('cost_sum', 'cost_count', 'today_return_pct', 'total_return_pct')
+    expected = results(Position, position_columns), results(Portfolio, portfolio_columns)
+    Position.query.update({'cost': 0, 'avg_buy_price': 0, 'cost_sum': None, 'cost_count': None,
+                           'today_return_pct': None, 'total_return_pct': None})
+    Portfolio.query.update({'cost_sum': None, 'cost_count': None, 'today_return_pct': None, 'total_return_pct': None})
+    history.session.commit()
+    account.recompute_returns()
+    history.session.expire_all()
+    assert results(Position, position_columns) == expected[0]
+    assert results(Portfolio, portfolio_columns) == expected[1]
+
+
+def test_recompute_returns_of_some_symbols_leaves_portfolios_alone(history):
+    Portfolio.query.update({'total_return_pct': None})
+    Position.query.update({'total_return_pct': None})
+    history.session.commit()
+    account.recompute_returns(['SPY'])
+    history.session.expire_all()
+    assert all(p.total_return_pct is None for p in Portfolio.query)
+    assert all(p.total_return_pct is not None for p in Position.query)
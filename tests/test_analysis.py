@@ -0,0 +1,55 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from app import analysis
+from app.analysis import Quote
+
+
+@pytest.fixture
+def quote(monkeypatch):
+    # five uncorrelated random walks, LOSER drifting down
+    monkeypatch.setenv('RISK_FREE_RATE', '0.02')
+    rng = np.random.default_rng(0)
+    returns = rng.normal(.001, .01, (300, 5)) - np.array([0, 0, 0, 0, .004])
+    data = pd.DataFrame(100 * np.cumprod(1 + returns, axis=0), columns=['A', 'B', 'C', 'D', 'LOSER'],
+                        index=pd.bdate_range('2020-01-01', periods=300))
+    return Quote.from_data(data, 21)
+
+
+def test_optimize_constrained_drops_a_losing_name(quote):
+    weights, *_ = quote.optimize_constrained(min_percent=.1, max_count=4)
+    assert 'LOSER' not in weights
+    assert sum(weights.values()) == pytest.approx(1, abs=.01)
+
+
+def test_optimize_constrained_holds_must_have_names_at_min_percent(quote):
+    weights, *_ = quote.optimize_constrained(min_percent=.1, max_count=4, must_have={'LOSER'})
+    assert weights['LOSER'] == pytest.approx(.1, abs=.001)
+    assert len(weights) <= 4
+    assert sum(weights.values()) == pytest.approx(1, abs=.01)
+
+
+def test_optimize_constrained_rejects_must_haves_that_cannot_fit(quote):
+    with pytest.raises(ValueError):
+        quote.optimize_constrained(min_percent=.4, max_count=4, must_have={'A', 'B', 'LOSER'})
+    with pytest.raises(ValueError):
+        quote.optimize_constrained(min_percent=.1, max_count=2, must_have={'A', 'B', 'LOSER'})
+
+
+def test_stream_statistics_scores_repeated_symbols_once_and_keeps_the_first_of_ties(monkeypatch):
+    # every symbol has the same prices, hence the same statistics
+    monkeypatch.setenv('RISK_FREE_RATE', '0.02')
+    prices = 100 * np.cumprod(1 + np.random.default_rng(0).normal(.001, .01, 100))
+    index = pd.bdate_range(end=pd.Timestamp.today().normalize(), periods=100)
+    fetched = []
+
+    def data_reader(symbols, start):
+        symbols = [symbols] if isinstance(symbols, str) else symbols
+        fetched.extend(symbols)
+        return pd.DataFrame({s: prices for s in symbols}, index=index)[start:]
+
+    monkeypatch.setattr(analysis, 'data_reader', data_reader)
+    stats = Quote.stream_statistics([['A', 'B', 'C'], ['B', 'D'], ['A', 'E']], 60, 5, top=3, batch_size=2)
+    assert fetched.count('B') == 1 and fetched.count('A') == 1
+    assert sorted(stats.index) == ['A', 'B', 'C']
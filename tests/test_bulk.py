@@ -0,0 +1,46 @@
+from datetime import datetime
+
+import pytest
+
+from app import bulk
+from app.account import Transfer
+from app.instrument import Instrument, Tag
+
+
+@pytest.fixture(params=['on conflict', 'select then write'])
+def dialect(request, database, monkeypatch):
+    if request.param == 'select then write':
+        monkeypatch.setattr(bulk, '_on_conflict_insert', lambda table, dialect: None)
+    elif bulk._on_conflict_insert(Transfer.__table__, 'sqlite') is None:
+        pytest.skip('sqlite on conflict needs sqlalchemy >= 1.4')
+    return database
+
+
+def transfers():
+    return {t.id: t.amount for t in Transfer.query.order_by(Transfer.id)}
+
+
+def test_bulk_upsert_inserts_then_updates(dialect):
+    day = datetime(2020, 1, 2)
+    assert bulk.bulk_upsert(Transfer, [{'id': 't1', 'created_at': day, 'amount': 1.},
+                                       {'id': 't2', 'created_at': day, 'amount': 2.}]) == 2
+    assert transfers() == {'t1': 1., 't2': 2.}
+    bulk.bulk_upsert(Transfer, [{'id': 't2', 'created_at': day, 'amount': 20.},
+                                {'id': 't3', 'created_at': day, 'amount': 3.}])
+    assert transfers() == {'t1': 1., 't2': 20., 't3': 3.}
+
+
+def test_bulk_upsert_keeps_the_last_duplicate(dialect):
+    day = datetime(2020, 1, 2)
+    assert bulk.bulk_upsert(Transfer, [{'id': 't1', 'created_at': day, 'amount': 1.},
+                                       {'id': 't1', 'created_at': day, 'amount': 5.}], chunk_size=1) == 1
+    assert transfers() == {'t1': 5.}
+
+
+def test_bulk_insert_missing_skips_existing_keys(database):
+    database.session.add(Instrument(symbol='SPY', robinhood_id='spy', name='SPY', list_date=datetime(2000, 1, 1),
+                                    popularity=1, last_update=datetime(2020, 1, 1)))
+    tags = [{'symbol': 'SPY', 'name': 'ETF'}, {'symbol': 'SPY', 'name': 'ETF'}, {'symbol': 'SPY', 'name': 'Index'}]
+    assert bulk.bulk_insert_missing(Tag, tags, ('symbol', 'name')) == 2
+    assert bulk.bulk_insert_missing(Tag, tags + [{'symbol': 'SPY', 'name': 'Large'}], ('symbol', 'name')) == 1
+    assert sorted(t.name for t in Tag.query) == ['ETF', 'Index', 'Large']
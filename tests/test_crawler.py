@@ -0,0 +1,54 @@
+import json
+
+import pytest
+
+fakeredis = pytest.importorskip('fakeredis')
+
+from app import crawler  # noqa: E402
+
+
+@pytest.fixture
+def conn(monkeypatch):
+    monkeypatch.setattr(crawler, 'BATCH_SIZE', 2)
+    return fakeredis.FakeStrictRedis()
+
+
+def frontier(conn):
+    return [s.decode() for s in conn.lrange(crawler.FRONTIER, 0, -1)]
+
+
+def test_push_frontier_skips_seen_ids(conn):
+    assert crawler.push_frontier(conn, ['a', 'b', 'a']) == 2
+    assert crawler.push_frontier(conn, ['b', 'c']) == 1
+    assert crawler.push_frontier(conn, []) == 0
+    assert frontier(conn) == ['a', 'b', 'c']
+    assert conn.smembers(crawler.SEEN) == {b'a', b'b', b'c'}
+
+
+def test_pop_batch_moves_ids_in_flight(conn):
+    crawler.push_frontier(conn, ['a', 'b', 'c'])
+    batch_id, chunk = crawler.pop_batch(conn)
+    assert chunk == ['a', 'b']
+    assert frontier(conn) == ['c']
+    assert json.loads(conn.hget(crawler.INFLIGHT, batch_id)) == ['a', 'b']
+    assert crawler.pop_batch(conn)[1] == ['c']
+    assert crawler.pop_batch(conn) == (None, None)
+    assert conn.hlen(crawler.INFLIGHT) == 2
+
+
+def test_requeue_inflight_restores_orphaned_batches_in_order(conn):
+    crawler.push_frontier(conn, ['a', 'b', 'c'])
+    crawler.pop_batch(conn)
+    assert crawler.requeue_inflight(conn) == 1
+    assert frontier(conn) == ['a', 'b', 'c']
+    assert conn.hlen(crawler.INFLIGHT) == 0
+    assert crawler.requeue_inflight(conn) == 0
+
+
+def test_requeue_inflight_keeps_queued_batches(conn):
+    crawler.push_frontier(conn, ['a', 'b', 'c'])
+    batch_id, chunk = crawler.pop_batch(conn)
+    crawler.instruments_queue(conn).enqueue(crawler.crawl_batch, batch_id, chunk, 300, job_id=batch_id)
+    assert crawler.requeue_inflight(conn) == 0
+    assert frontier(conn) == ['c']
+    assert conn.hexists(crawler.INFLIGHT, batch_id)
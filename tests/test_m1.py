@@ -0,0 +1,173 @@
+import base64
+import json
+import re
+import time
+from datetime import date
+
+import pytest
+import requests
+from requests.adapters import BaseAdapter
+from requests.models import Response
+
+from app import create_app, db, m1
+
+PERFORMANCE = {'startValue': {'date': '2020-01-01T00:00:00Z', 'value': 100},
+               'endValue': {'date': '2020-01-02T00:00:00Z', 'value': 101},
+               'moneyWeightedRateOfReturn': 1, 'totalGain': 1, 'capitalGain': 1, 'earnedDividends': 0,
+               'netCashFlow': 0}
+
+
+def jwt(exp):
+    return 'h.' + base64.urlsafe_b64encode(json.dumps({'exp': exp}).encode()).decode().rstrip('=') + '.s'
+
+
+def performance(arguments):
+    end = re.search(r'endDate: "([\d-]+)"', arguments)
+    return {**PERFORMANCE, 'startValue': {'date': f'{end.group(1) if end else "2020-01-01"}T00:00:00Z', 'value': 100}}
+
+
+class FakeM1(BaseAdapter):
+    # Issues tokens and answers performance queries. Requests with a token it did not issue get a graphql error
+    # payload with http 200, or a 401 with unauthorized='http'. The next `failures` queries get a 500. Arguments
+    # listed in `unknown` fail validation.
+    def __init__(self, unauthorized='graphql'):
+        super().__init__()
+        self.unauthorized, self.logins, self.queries, self.tokens = unauthorized, 0, [], set()
+        self.failures, self.unknown = 0, ()
+
+    def send(self, request, **kwargs):
+        query = json.loads(request.body)['query']
+        response = Response()
+        response.status_code, response.url, response.request, response.encoding = 200, request.url, request, 'utf-8'
+        if 'authenticate' in query:
+            self.logins += 1
+            token = jwt(time.time() + 3600) + str(self.logins)
+            self.tokens.add(token)
+            payload = {'data': {'authenticate': {'accessToken': token}}}
+        elif request.headers.get('Authorization', '')[len('Bearer '):] not in self.tokens:
+            if self.unauthorized == 'http':
+                response.status_code, payload = 401, {}
+            else:
+                payload = {'errors': [{'message': 'token expired', 'extensions': {'code': 'UNAUTHENTICATED'}}]}
+        elif self.failures:
+            self.failures -= 1
+            response.status_code, response._content = 500, b'Internal Server Error'
+            return response
+        elif any(f'{argument}:' in query for argument in self.unknown):
+            self.queries.append(query)
+            payload = {'errors': [{'message': f'Unknown argument "{self.unknown[0]}"',
+                                   'extensions': {'code': 'GRAPHQL_VALIDATION_FAILED'}}]}
+        else:
+            self.queries.append(query)
+            payload = {'data': {'node': {alias: performance(arguments)
+                                         for alias, arguments in re.findall(r'(\w+): performance\(([^)]*)\)', query)}}}
+        response._content = json.dumps(payload).encode()
+        return response
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def server(monkeypatch, tmp_path):
+    monkeypatch.setenv('CACHE_DIR', str(tmp_path))
+    monkeypatch.setenv('M1_USERNAME', 'user')
+    monkeypatch.setenv('M1_PASSWORD', 'password')
+    return FakeM1()
+
+
+def mounted(http, server):
+    http.mount('https://', server)
+    return http
+
+
+def client(server, **kwargs):
+    return m1.M1Client(mounted(requests.Session(), server), **kwargs)
+
+
+def test_token_is_reused_across_clients(server):
+    assert client(server).current_value('acct') == 101
+    assert client(server).current_value('acct') == 101
+    assert server.logins == 1
+
+
+def test_expired_stored_token_logs_in_again(server):
+    first = client(server)
+    first.current_value('acct')
+    first.expires_at = time.time() - 1
+    first.save_token()
+    client(server).current_value('acct')
+    assert server.logins == 2
+
+
+def test_token_is_not_persisted_on_request(server):
+    client(server, persist=False).current_value('acct')
+    client(server, persist=False).current_value('acct')
+    assert server.logins == 2
+
+
+@pytest.mark.parametrize('unauthorized', ['graphql', 'http'])
+def test_rejected_token_is_renewed_once(server, unauthorized):
+    server.unauthorized = unauthorized
+    stale = client(server)
+    stale.token, stale.expires_at = 'revoked', time.time() + 3600
+    assert stale.current_value('acct') == 101
+    assert server.logins == 1
+    assert len(server.queries) == 1
+
+
+@pytest.fixture
+def backfill(server, monkeypatch, tmp_path):
+    monkeypatch.setenv('M1_ACCOUNTS', 'Individual:acct')
+    monkeypatch.setattr(m1.time, 'sleep', lambda seconds: None)
+    session = requests.Session
+    monkeypatch.setattr(m1.requests, 'Session', lambda: mounted(session(), server))
+    app = create_app()
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + str(tmp_path / 'portfolio')
+    with app.app_context():
+        db.create_all()
+        yield lambda **kwargs: m1.backfill_m1_account(date(2020, 1, 6), date(2020, 1, 17), batch_size=4, **kwargs)
+        db.session.remove()
+
+
+def stored_days():
+    return sorted(d for d, in db.session.query(m1.M1Portfolio.date))
+
+
+def test_backfill_retries_failed_requests(server, backfill):
+    server.failures = 2
+    backfill(workers=1, retries=2)
+    assert len(stored_days()) == 10
+    assert stored_days()[0] == date(2020, 1, 6)
+    assert server.failures == 0
+
+
+def test_backfill_gives_up_on_a_batch_after_retries(server, backfill):
+    server.failures = 3
+    backfill(workers=1, retries=2)
+    assert stored_days() == [date(2020, 1, d) for d in (10, 13, 14, 15, 16, 17)]
+
+
+def test_backfill_rerun_fills_only_missing_days(server, backfill):
+    server.failures = 3
+    backfill(workers=1, retries=2)
+    backfill(workers=2)
+    assert len(stored_days()) == 10
+    assert len(server.queries) == 3
+    assert server.logins == 1
+
+
+def test_backfill_without_missing_days_does_not_log_in(server, backfill):
+    backfill()
+    requests_made = server.logins, len(server.queries)
+    backfill()
+    assert (server.logins, len(server.queries)) == requests_made
+    assert len(stored_days()) == 10
+
+
+def test_backfill_fails_loudly_on_rejected_arguments(server, backfill):
+    server.unknown = ('endDate',)
+    with pytest.raises(RuntimeError, match='endDate'):
+        backfill(workers=1, retries=2)
+    assert len(set(server.queries)) == len(server.queries)  # no batch was retried
+    assert stored_days() == []
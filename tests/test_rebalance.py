@@ -0,0 +1,31 @@
+import pytest
+
+from app.rebalance import Trade, rebalance
+
+TARGETS = {'A': 50, 'B': 30, 'C': 20}
+HOLDINGS = {'A': 10, 'C': 20, 'D': 3}
+PRICES = {'A': 100., 'B': 50., 'C': 99., 'D': 10.}
+
+
+def trades(result):
+    return {t.symbol: (round(t.quantity, 4), t.amount) for t in result}
+
+
+def test_rebalance_matches_the_per_setting_recommendations():
+    # buying power times the setting's percent less the equity held, outside a 2% band, and held symbols without
+    # a setting sold off
+    result = rebalance(TARGETS, HOLDINGS, PRICES, 10000)
+    assert trades(result) == {'A': (40., 4000.), 'B': (60., 3000.), 'D': (-3., -30.)}
+    assert result[0] == Trade(None, 'A', 40., 100., 4000., 5000., 1000.)
+
+
+def test_rebalance_scales_buys_down_only_when_available_is_given():
+    result = rebalance(TARGETS, HOLDINGS, PRICES, 10000, available=1000)
+    assert sum(t.amount for t in result if t.amount > 0) == pytest.approx(1030)
+    assert trades(result)['D'] == (-3., -30.)
+
+
+def test_rebalance_whole_shares_and_min_trade():
+    result = rebalance({'A': 50, 'B': 50}, {}, {'A': 30., 'B': 7.}, 1000, whole_shares=True, min_trade=400)
+    assert trades(result) == {'A': (16., 480.), 'B': (71., 497.)}
+    assert trades(rebalance({'A': 50}, {}, {'A': 30.}, 100, whole_shares=True, min_trade=60)) == {}
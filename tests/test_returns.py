@@ -0,0 +1,73 @@
+from datetime import date, datetime, timedelta
+
+import pandas as pd
+import pytest
+
+from app import analysis, returns
+from app.m1 import M1Portfolio
+
+
+def add_day(database, day, rate, updated):
+    database.session.add(M1Portfolio(account='Individual', date=day, day_return_rate=rate, last_update=updated,
+                                     day_start_time=datetime.combine(day, datetime.min.time())))
+    database.session.commit()
+
+
+def account_returns():
+    return returns.table_returns('account-Individual', M1Portfolio, M1Portfolio.day_return_rate,
+                                 M1Portfolio.account == 'Individual')
+
+
+def test_table_returns_reads_only_rows_updated_since_the_cache(database, monkeypatch):
+    add_day(database, date(2020, 1, 2), 1., datetime(2020, 1, 2, 22))
+    add_day(database, date(2020, 1, 3), 2., datetime(2020, 1, 3, 22))
+    assert account_returns().tolist() == [.01, .02]
+    assert returns.load('account-Individual')['watermark'] == datetime(2020, 1, 3, 22)
+
+    read_sql, reads = pd.read_sql, []
+
+    def counted(*args, **kwargs):
+        rows = read_sql(*args, **kwargs)
+        reads.append(len(rows))
+        return rows
+
+    monkeypatch.setattr(pd, 'read_sql', counted)
+    assert account_returns().tolist() == [.01, .02]
+
+    M1Portfolio.query.filter_by(date=date(2020, 1, 3)).update({'day_return_rate': -1., 'last_update':
+                                                               datetime(2020, 1, 4, 9)})
+    add_day(database, date(2020, 1, 6), 3., datetime(2020, 1, 6, 22))
+    assert account_returns().to_dict() == {pd.Timestamp(2020, 1, 2): .01, pd.Timestamp(2020, 1, 3): -.01,
+                                           pd.Timestamp(2020, 1, 6): .03}
+    assert reads == [0, 2]
+
+
+@pytest.fixture
+def vendor(database, monkeypatch):
+    calls = []
+    prices = pd.Series([100., 101., 102., 103., 104.], pd.bdate_range('2020-01-01', periods=5))
+
+    def data_reader(symbols, start):
+        calls.append(pd.Timestamp(start))
+        return pd.DataFrame({symbols[0]: prices[prices.index >= pd.Timestamp(start)]})
+
+    monkeypatch.setattr(analysis, 'data_reader', data_reader)
+    return calls
+
+
+def test_quote_returns_are_served_from_cache_until_the_vendor_ttl(vendor, monkeypatch):
+    start = pd.Timestamp(2020, 1, 1)
+    first = returns.quote_returns('SPY', start)
+    assert len(first) == 4
+    assert returns.quote_returns('SPY', start).equals(first)
+    assert len(vendor) == 1
+
+    monkeypatch.setattr(returns, 'VENDOR_TTL', timedelta(0))
+    assert returns.quote_returns('SPY', start).equals(first)
+    assert vendor[-1] == first.index[-1] - returns.OVERLAP
+
+
+def test_quote_returns_refetch_an_earlier_start(vendor):
+    returns.quote_returns('SPY', pd.Timestamp(2020, 1, 3))
+    assert len(returns.quote_returns('SPY', pd.Timestamp(2020, 1, 1))) == 4
+    assert vendor == [pd.Timestamp(2020, 1, 3), pd.Timestamp(2020, 1, 1)]
@@ -0,0 +1,20 @@
+from datetime import date, datetime, timezone
+
+from app.snapshot import EquitySnapshot, SnapshotBuffer
+
+
+def epoch(*args):
+    return datetime(*args, tzinfo=timezone.utc).timestamp()
+
+
+def test_series_takes_dates_or_datetimes_and_sorts_late_samples(database):
+    for batch in ([epoch(2020, 1, 1, 15), epoch(2020, 1, 2, 15)], [epoch(2020, 1, 1, 14), epoch(2020, 1, 3, 15)]):
+        buffer = SnapshotBuffer()
+        for timestamp in batch:
+            buffer.add('Individual', timestamp, timestamp)
+        buffer.flush()
+    by_date = EquitySnapshot.series('Individual', date(2020, 1, 1), date(2020, 1, 2))
+    assert list(by_date.index) == [datetime(2020, 1, 1, 14), datetime(2020, 1, 1, 15), datetime(2020, 1, 2, 15)]
+    by_datetime = EquitySnapshot.series('Individual', datetime(2020, 1, 1, 14, 30), datetime(2020, 1, 3, 12))
+    assert list(by_datetime.index) == [datetime(2020, 1, 1, 15), datetime(2020, 1, 2, 15)]
+    assert len(EquitySnapshot.series('Individual')) == 4